@@ -0,0 +1,325 @@
+#!/usr/bin/env python2.7
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Throughput benchmark for Shirk's line handling.
+
+Feeds synthetic (or recorded) IRC traffic straight into Shirk.lineReceived
+over a fake transport, with the Core and Auth plugs loaded, and reports lines
+per second, how long the event_* dispatch methods take and how big the user
+table gets.  Run it from anywhere:
+
+    python2.7 bench/bench.py [--users N] [--scale N] [scenario ...]
+
+Without arguments every scenario is run, in order.  `--replay FILE` feeds the
+raw lines in FILE (one per line, as received from the server, or a capture
+file from recorder.py) instead.
+
+"""
+
+import argparse
+import gc
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from twisted.internet import reactor
+from twisted.python import threadable
+from twisted.test import proto_helpers
+
+import recorder
+import sendqueue
+import shirk
+import users
+
+NICK = 'shirk'
+SERVER = 'irc.example.net'
+SPLIT = 'hub.example.net leaf.example.net'
+
+
+class Network(object):
+    """Made-up users and channels to generate traffic for."""
+
+    def __init__(self, nusers, nchannels, seed=0):
+        self.random = random.Random(seed)
+        self.nicks = ['user%d' % (i,) for i in xrange(nusers)]
+        self.channels = ['#chan%d' % (i,) for i in xrange(nchannels)]
+        self.renamed = {}
+
+    def prefix(self, nick):
+        base = self.renamed.get(nick, nick)
+        return '%s!%s@%s.example.com' % (nick, base[:10], base)
+
+    def channel_users(self, channel):
+        """Everyone's in the first channel, the rest get a slice each."""
+        index = self.channels.index(channel)
+        if index == 0:
+            return self.nicks
+        return self.nicks[index::len(self.channels)]
+
+    def chatter(self):
+        return ' '.join(self.random.choice(('lorem', 'ipsum', 'dolor', 'sit',
+            'amet', 'shirk:', 'http://example.com/', '\xc3\xa9t\xc3\xa9'))
+            for i in xrange(self.random.randint(3, 20)))
+
+
+def mass_who(net, scale):
+    """Join every channel and get a WHO reply for all of its users."""
+    for channel in net.channels:
+        yield ':%s!%s@bot.example.com JOIN %s' % (NICK, NICK, channel)
+        for nick in net.channel_users(channel):
+            yield (':%s 352 %s %s %s %s.example.com %s %s H :0 %s'
+                   % (SERVER, NICK, channel, nick[:10], nick, SERVER, nick,
+                      nick))
+        yield ':%s 315 %s %s :End of /WHO list.' % (SERVER, NICK, channel)
+
+
+def privmsg_flood(net, scale):
+    """Channel chatter, the bulk of what a bot sees."""
+    for i in xrange(scale * 20):
+        channel = net.random.choice(net.channels)
+        nick = net.random.choice(net.channel_users(channel))
+        yield ':%s PRIVMSG %s :%s' % (net.prefix(nick), channel, net.chatter())
+
+
+def command_burst(net, scale):
+    """Lots of !commands, which end up in the Core and Auth plugs."""
+    commands = ('!ping', '!commands', '!plugs', '!whoami', '!nosuchcommand')
+    for i in xrange(scale * 5):
+        channel = net.random.choice(net.channels)
+        nick = net.random.choice(net.channel_users(channel))
+        yield ':%s PRIVMSG %s :%s' % (net.prefix(nick), channel,
+                                      net.random.choice(commands))
+
+
+def netsplit(net, scale):
+    """Half the users split off and come back."""
+    gone = net.nicks[::2]
+    for nick in gone:
+        yield ':%s QUIT :%s' % (net.prefix(nick), SPLIT)
+    for channel in net.channels:
+        for nick in net.channel_users(channel)[::2]:
+            yield ':%s JOIN %s' % (net.prefix(nick), channel)
+
+
+def nick_storm(net, scale):
+    """Everybody changes nicks and back again, a few times over."""
+    for i in xrange(max(1, scale // 100)):
+        for nick in net.nicks:
+            new = nick + '_away'
+            net.renamed[new] = nick
+            yield ':%s NICK :%s' % (net.prefix(nick), new)
+            yield ':%s NICK :%s' % (net.prefix(new), nick)
+            del net.renamed[new]
+
+
+SCENARIOS = [('who', mass_who), ('privmsg', privmsg_flood),
+             ('commands', command_burst), ('netsplit', netsplit),
+             ('nicks', nick_storm)]
+
+
+def replay(path):
+    """Raw lines from a file, without their line endings.
+
+    The file is either a capture written by recorder.Recorder, in which case
+    the inbound lines are used, or plain text.
+
+    """
+    if path.endswith(recorder.SUFFIX):
+        for timestamp, direction, line in recorder.read_capture(path):
+            if direction == recorder.INBOUND:
+                yield line
+        return
+    with open(path, 'rb') as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+class DispatchTimer(object):
+    """Times every call to the event_* methods of a Shirk instance."""
+
+    def __init__(self, bot):
+        self.timings = {}
+        for name in dir(bot.__class__):
+            if name.startswith('event_'):
+                setattr(bot, name, self.wrap(name, getattr(bot, name)))
+
+    def wrap(self, name, f):
+        timings = self.timings.setdefault(name, [])
+        clock = time.time
+        def timed(*args):
+            start = clock()
+            try:
+                return f(*args)
+            finally:
+                timings.append(clock() - start)
+        return timed
+
+    def reset(self):
+        for timings in self.timings.itervalues():
+            del timings[:]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def sizeof(obj, seen):
+    """Rough deep size of obj, not counting anything in `seen`."""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+    elif isinstance(obj, users.User):
+        for slot in users.User.__slots__:
+            if slot != '__weakref__' and hasattr(obj, slot):
+                size += sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def users_size(table):
+    """Size of the user table and everything in it, in bytes."""
+    # The core and the casemapping tables aren't part of the user data.
+    seen = set([id(table.core), id(table.log), id(table._fold_str),
+                id(table._fold_unicode)])
+    return sizeof(table.__dict__, seen)
+
+
+class Bench(object):
+    """A Shirk instance on a fake transport and the numbers it produces."""
+
+    def __init__(self, options, tmpdir):
+        self.options = options
+        config = dict(shirk.DEFAULT_CONFIG)
+        config.update({
+            'nickname': NICK,
+            'plugs': ['Core', 'Auth'],
+            'snapshot_file': os.path.join(tmpdir, 'snapshot.json'),
+            'profile_dir': tmpdir,
+            # Measure the commands, not the flood limits.
+            'cmd_exempt_power': 0,
+        })
+        log = logging.getLogger('shirk')
+        factory = shirk.ShirkFactory(config, log)
+        self.bot = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.bot.makeConnection(self.transport)
+        self.bot.lineReceived(':%s 001 %s :Welcome' % (SERVER, NICK))
+        self.bot.lineReceived(':%s 005 %s CASEMAPPING=rfc1459 :are supported'
+                              % (SERVER, NICK))
+        self.bot.stopHeartbeat()
+        # Outgoing flood control would only measure the wall clock.
+        self.bot.send_bucket = sendqueue.TokenBucket(1e9, 1e9)
+        # Load Core right away rather than on the first command.
+        self.bot.load_plug('Core')
+        auth = self.bot.plugs['Auth']
+        auth.known_nicks = ['user%d' % (i,) for i in xrange(0, 1000, 10)]
+        auth.hosts_auth = {'*.example.com': 1, 'user1.example.com': 10}
+        auth.build_index()
+        self.timer = DispatchTimer(self.bot)
+        self.peak_users = 0
+
+    def run(self, name, lines):
+        bot = self.bot
+        self.timer.reset()
+        gc.collect()
+        count = 0
+        elapsed = 0.0
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) == 1000:
+                elapsed += self.feed(batch)
+                count += len(batch)
+                batch = []
+                self.sample()
+        elapsed += self.feed(batch)
+        count += len(batch)
+        self.sample()
+        self.report(name, count, elapsed)
+
+    def feed(self, batch):
+        receive = self.bot.lineReceived
+        start = time.time()
+        for line in batch:
+            receive(line)
+        elapsed = time.time() - start
+        # Run timers and whatever threads passed back, then throw away the
+        # output so it doesn't pile up.
+        reactor.iterate(0)
+        self.transport.clear()
+        return elapsed
+
+    def sample(self):
+        self.peak_users = max(self.peak_users, users_size(self.bot.users))
+
+    def report(self, name, count, elapsed):
+        rate = count / elapsed if elapsed else float('inf')
+        print '%-10s %8d lines %8.3fs %10.0f lines/s' % (name, count,
+                                                         elapsed, rate)
+        for event, timings in sorted(self.timer.timings.iteritems()):
+            if not timings:
+                continue
+            timings.sort()
+            print '    %-20s %7d calls  p50 %7.1fus  p90 %7.1fus  ' \
+                  'p99 %7.1fus  max %8.1fus' % (event, len(timings),
+                percentile(timings, 0.5) * 1e6, percentile(timings, 0.9) * 1e6,
+                percentile(timings, 0.99) * 1e6, timings[-1] * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Shirk.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+        help='any of %s, default is all of them'
+             % (', '.join(name for name, gen in SCENARIOS),))
+    parser.add_argument('--users', type=int, default=5000,
+                        help='number of users on the fake network')
+    parser.add_argument('--channels', type=int, default=20,
+                        help='number of channels the bot is in')
+    parser.add_argument('--scale', type=int, default=1000,
+                        help='how much traffic the scenarios generate')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='feed the raw lines in FILE instead')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    scenarios = dict(SCENARIOS)
+    for name in options.scenarios:
+        if name not in scenarios:
+            parser.error('unknown scenario %s' % (name,))
+
+    logging.basicConfig(level=logging.ERROR)
+    # Plug configuration is looked up relative to the working directory.
+    os.chdir(ROOT)
+    threadable.registerAsIOThread()
+    tmpdir = tempfile.mkdtemp(prefix='shirk-bench-')
+    try:
+        bench = Bench(options, tmpdir)
+        if options.replay:
+            bench.run('replay', replay(options.replay))
+        else:
+            net = Network(options.users, options.channels, options.seed)
+            for name, generate in SCENARIOS:
+                if not options.scenarios or name in options.scenarios or \
+                        name == 'who':
+                    # Everything else needs the users to be there first.
+                    bench.run(name, generate(net, options.scale))
+        print 'Users peak size: %.1f KiB' % (bench.peak_users / 1024.0,)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Remembering what command handlers answered, see plugbase.cached."""
+
+import time
+import weakref
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """The cached responses of one plug's handlers, least recently used
+    first.
+
+    Entries are (weakref to the core, generation, expiry time, size,
+    responses) and only count for the core they were made for, as long as
+    its generation (see Shirk.generation) hasn't moved on.  The weakref lets
+    an old connection go once the bot has reconnected.  Each handler has a
+    limit on how many entries it keeps and all of them together are limited
+    to `max_bytes`, roughly.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # (handler name, key) -> entry
+        self.entries = OrderedDict()
+        # handler name -> number of entries
+        self.counts = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, key, core):
+        """Return the responses stored for key, or None."""
+        entry = self.entries.pop((name, key), None)
+        if entry is not None:
+            if entry[0]() is core and entry[1] == core.generation and \
+                    entry[2] > time.time():
+                # Back on top of the list.
+                self.entries[(name, key)] = entry
+                self.hits += 1
+                return entry[4]
+            self._forget(name, entry)
+        self.misses += 1
+        return None
+
+    def put(self, name, key, core, ttl, maxsize, responses):
+        size = 100 + len(repr(key)) + sum(len(msg) + 50
+                                          for msg, rkey, rttl in responses)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop((name, key), None)
+        if old is not None:
+            self._forget(name, old)
+        self.entries[(name, key)] = (weakref.ref(core), core.generation,
+                                     time.time() + ttl, size, responses)
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.size += size
+        if self.counts[name] > maxsize:
+            for (oldname, oldkey), entry in self.entries.iteritems():
+                if oldname == name:
+                    self._evict(oldname, oldkey)
+                    break
+        while self.size > self.max_bytes:
+            (oldname, oldkey), entry = next(self.entries.iteritems())
+            self._evict(oldname, oldkey)
+
+    def clear(self):
+        self.entries.clear()
+        self.counts.clear()
+        self.size = 0
+
+    def _evict(self, name, key):
+        self._forget(name, self.entries.pop((name, key)))
+        self.evictions += 1
+
+    def _forget(self, name, entry):
+        self.counts[name] -= 1
+        self.size -= entry[3]
@@ -0,0 +1,190 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Routing and throttling of !commands.
+
+Every message that starts with the command prefix passes through here before
+anything is split or dispatched: the Router works out which command (if any)
+the first word stands for, and the FloodGuard decides whether the user gets
+to run it right now.
+
+"""
+
+from sendqueue import TokenBucket
+
+
+class Argv(list):
+    """The command and its whitespace-separated arguments.
+
+    Also keeps the `rest` of the line after the command as it was typed, for
+    handlers that parse their arguments themselves (see plugbase.command).
+    The arguments are only split off the first time anything past argv[0]
+    is looked at, so handlers with their own parser don't pay for it.
+
+    """
+    __slots__ = ('rest', '_unsplit')
+
+    def __init__(self, cmd, rest):
+        list.__init__(self, [cmd])
+        self.rest = rest
+        self._unsplit = True
+
+    def _split(self):
+        self._unsplit = False
+        list.extend(self, self.rest.split())
+
+    def __getitem__(self, index):
+        if self._unsplit and index != 0:
+            self._split()
+        return list.__getitem__(self, index)
+
+
+def _splitting(name):
+    method = getattr(list, name)
+    def f(self, *args):
+        if self._unsplit:
+            self._split()
+        return method(self, *args)
+    f.__name__ = name
+    return f
+
+# Everything else a list does, bar __getitem__ above, splits first.
+for _name in ('__add__', '__contains__', '__delitem__', '__delslice__',
+              '__eq__', '__ge__', '__getslice__', '__gt__', '__iadd__',
+              '__imul__', '__iter__', '__le__', '__len__', '__lt__',
+              '__mul__', '__ne__', '__repr__', '__reversed__', '__rmul__',
+              '__setitem__', '__setslice__', 'append', 'count', 'extend',
+              'index', 'insert', 'pop', 'remove', 'reverse', 'sort'):
+    setattr(Argv, _name, _splitting(_name))
+del _name
+
+
+class Router(object):
+    """Maps what users type to the registered commands.
+
+    Besides the commands themselves that's their aliases and, if
+    `abbreviations` is on, any prefix that only one command or alias starts
+    with.  `table` is the core's command dispatch table, commands without
+    any plugs in there are ignored.  The lookup table is only rebuilt when
+    something changed.
+
+    """
+    def __init__(self, table, abbreviations=False):
+        self.table = table
+        self.abbreviations = abbreviations
+        # alias -> command
+        self.aliases = {}
+        # command -> how much it counts towards the flood limits
+        self.costs = {}
+        self._routes = None
+
+    def add(self, cmd, aliases=(), cost=1):
+        """Register cmd, replacing whatever aliases and cost it had."""
+        self._drop_aliases(cmd)
+        for alias in aliases:
+            self.aliases[alias] = cmd
+        self.costs[cmd] = cost
+        self._routes = None
+
+    def remove(self, cmd):
+        """Forget cmd's aliases and cost, once no plug handles it."""
+        self._drop_aliases(cmd)
+        self.costs.pop(cmd, None)
+        self._routes = None
+
+    def _drop_aliases(self, cmd):
+        for alias in [alias for alias, target in self.aliases.iteritems()
+                      if target == cmd]:
+            del self.aliases[alias]
+
+    def invalidate(self):
+        self._routes = None
+
+    def resolve(self, word):
+        """Return the command word stands for, or None."""
+        routes = self._routes
+        if routes is None:
+            routes = self._routes = self._build()
+        return routes.get(word)
+
+    def _build(self):
+        names = dict((cmd, cmd) for cmd, plugs in self.table.iteritems()
+                     if plugs)
+        for alias, cmd in self.aliases.iteritems():
+            if cmd in names and alias not in names:
+                names[alias] = cmd
+        routes = {}
+        if self.abbreviations:
+            for name, cmd in names.iteritems():
+                for end in xrange(1, len(name)):
+                    prefix = name[:end]
+                    if routes.setdefault(prefix, cmd) != cmd:
+                        # Ambiguous.
+                        routes[prefix] = None
+            routes = dict((prefix, cmd) for prefix, cmd in routes.iteritems()
+                          if cmd is not None)
+        routes.update(names)
+        return routes
+
+
+class FloodGuard(object):
+    """Per-user and per-channel limits on how fast commands come in.
+
+    Each user and each channel gets a TokenBucket, and a command has to fit
+    in both or it's dropped without a word.  A rate of 0 turns that limit
+    off.  Users with at least `exempt_power` aren't limited at all.
+
+    """
+    # Start forgetting idle users' buckets once there are this many.
+    max_buckets = 1000
+
+    def __init__(self, users, user_rate, user_burst, channel_rate,
+                 channel_burst, exempt_power):
+        self.users = users
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.exempt_power = exempt_power
+        self.user_buckets = {}
+        self.channel_buckets = {}
+        self.dropped = 0
+
+    def allow(self, source, channel, cost=1):
+        """May source run a command that costs `cost` in channel?
+
+        channel is None for private messages.
+
+        """
+        user = self.users.by_nick(source)
+        if user is not None and user.power >= self.exempt_power:
+            return True
+        buckets = []
+        if self.user_rate:
+            buckets.append(self._bucket(self.user_buckets, source,
+                                        self.user_rate, self.user_burst))
+        if channel is not None and self.channel_rate:
+            buckets.append(self._bucket(self.channel_buckets, channel,
+                                        self.channel_rate, self.channel_burst))
+        for bucket in buckets:
+            if not bucket.ready(min(cost, bucket.burst)):
+                self.dropped += 1
+                return False
+        for bucket in buckets:
+            bucket.consume(min(cost, bucket.burst))
+        return True
+
+    def _bucket(self, buckets, name, rate, burst):
+        key = self.users.fold(name)
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_buckets:
+                self._prune(buckets)
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _prune(self, buckets):
+        """Forget the buckets that have filled up again."""
+        for key, bucket in buckets.items():
+            if bucket.ready(bucket.burst):
+                del buckets[key]
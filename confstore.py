@@ -0,0 +1,138 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""The plug configuration files in plugconf/, and keeping up with them.
+
+Every file is parsed once per change, no matter how many plugs or networks
+use it, and while the bot runs the files are stat()ed every so often.  When one has
+changed the plugs using it are told which keys are different, see
+Plug.reconfigure, so they can apply a change without being reloaded.
+
+"""
+
+import json
+import logging
+import os
+
+from twisted.internet import task
+
+# What Plug.reconfigure gets for keys that were removed from the file.
+DELETED = object()
+
+
+class ConfigStore(object):
+    """Parsed config files, by plug name.
+
+    The parsed values are shared between everyone who asked for them, so
+    they mustn't be modified in place.
+
+    """
+    def __init__(self, directory='plugconf', interval=5, log=None):
+        self.log = (log or logging.getLogger('shirk')).getChild('ConfigStore')
+        self.directory = directory
+        self.interval = interval
+        # name -> ((mtime, size) or None if there's no file, config)
+        self.files = {}
+        # name -> {core: plug}
+        self.watchers = {}
+        self._loop = None
+
+    def path(self, name):
+        return os.path.join(self.directory, '%s.json' % (name,))
+
+    def get(self, name):
+        """The config for the plug called name, {} if it has no file.
+
+        The file is stat()ed every time, so an edit is picked up right away
+        even if nobody's watching it or checks are off.
+
+        """
+        return self._refresh(name)
+
+    def watch(self, name, core, plug):
+        """Have core.reconfigure_plug(plug, changed) called on changes.
+
+        There's one plug per core and name, a later call replaces the
+        earlier one.
+
+        """
+        self.get(name)
+        self.watchers.setdefault(name, {})[core] = plug
+
+    def unwatch(self, name, core):
+        plugs = self.watchers.get(name)
+        if plugs is not None:
+            plugs.pop(core, None)
+            if not plugs:
+                del self.watchers[name]
+                self.files.pop(name, None)
+
+    def start(self):
+        """Check for changes every `interval` seconds, if it isn't 0."""
+        if self._loop is None and self.interval:
+            self._loop = task.LoopingCall(self.check)
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
+
+    def check(self):
+        """Reload the watched files that changed and tell their plugs."""
+        for name in list(self.watchers):
+            self._refresh(name)
+
+    def _refresh(self, name):
+        """Reload name's file if it changed, tell its plugs, return it."""
+        stamp = self._stamp(name)
+        entry = self.files.get(name)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        old = {} if entry is None else entry[1]
+        config = self._parse(name, stamp, old)
+        self.files[name] = (stamp, config)
+        if entry is None:
+            return config
+        changed = dict((key, value) for key, value in config.iteritems()
+                       if key not in old or old[key] != value)
+        for key in old:
+            if key not in config:
+                changed[key] = DELETED
+        if not changed:
+            return config
+        self.log.info('%s changed: %s', self.path(name),
+                      ', '.join(sorted(changed)))
+        for core, plug in self.watchers.get(name, {}).items():
+            try:
+                core.reconfigure_plug(plug, changed)
+            except Exception:
+                self.log.exception('Failed to reconfigure %s', name)
+        return config
+
+    def _stamp(self, name):
+        try:
+            st = os.stat(self.path(name))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _parse(self, name, stamp, old):
+        """Read name's file, or return `old` if it can't be read."""
+        if stamp is None:
+            return {}
+        try:
+            with open(self.path(name)) as f:
+                config = json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            self.log.warning('Ignoring broken config file %s',
+                             self.path(name))
+            return old
+        if not isinstance(config, dict):
+            self.log.warning('Ignoring config file %s, it should hold an '
+                             'object', self.path(name))
+            return old
+        return config
@@ -0,0 +1,90 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Lazy IRC line parsing for Shirk.
+
+irc.parsemsg wants a fully decoded line and always builds the parameter list,
+even for lines nobody is interested in.  Message only splits off the command
+up front and leaves decoding of the prefix and parameters until somebody
+actually asks for them.
+
+"""
+
+from twisted.words.protocols import irc
+
+# Quote character used by the low-level CTCP quoting, see irc.lowDequote.
+M_QUOTE = irc.M_QUOTE
+
+
+class Message(object):
+    """A single line received from the server.
+
+    `command` is available straight away (as a bytestring, e.g. 'PRIVMSG' or
+    '352'), `prefix` and `params` are decoded using `charset` the first time
+    they are accessed and behave exactly like the values irc.parsemsg returns
+    for the decoded line.
+
+    """
+    __slots__ = ('line', 'charset', 'command', '_rawprefix', '_rawparams',
+                 '_prefix', '_params')
+
+    def __init__(self, line, charset):
+        """Split line into prefix, command and the rest.
+
+        Raises irc.IRCBadMessage when there's no command to be found.
+
+        """
+        if M_QUOTE in line:
+            line = irc.lowDequote(line)
+        self.line = line
+        self.charset = charset
+        self._prefix = None
+        self._params = None
+        if not line:
+            raise irc.IRCBadMessage('Empty line.')
+        if line[0] == ':':
+            end = line.find(' ')
+            if end == -1:
+                raise irc.IRCBadMessage('Prefix without command.')
+            self._rawprefix = line[1:end]
+            start = end + 1
+        else:
+            self._rawprefix = ''
+            start = 0
+        # Skip the extra spaces some servers throw in, like str.split() would.
+        while line[start:start + 1] == ' ':
+            start += 1
+        end = line.find(' ', start)
+        if end == -1:
+            self.command = line[start:]
+            self._rawparams = ''
+        else:
+            self.command = line[start:end]
+            self._rawparams = line[end + 1:]
+        if not self.command:
+            raise irc.IRCBadMessage('No command.')
+
+    @property
+    def prefix(self):
+        if self._prefix is None:
+            self._prefix = self._rawprefix.decode(self.charset, 'replace')
+        return self._prefix
+
+    @property
+    def params(self):
+        if self._params is None:
+            charset = self.charset
+            raw = ' ' + self._rawparams
+            trailing = raw.find(' :')
+            if trailing == -1:
+                params = [p.decode(charset, 'replace') for p in raw.split()]
+            else:
+                params = [p.decode(charset, 'replace')
+                          for p in raw[:trailing].split()]
+                params.append(raw[trailing + 2:].decode(charset, 'replace'))
+            self._params = params
+        return self._params
+
+    def decoded(self):
+        """The full line, decoded, for logging and badMessage."""
+        return self.line.decode(self.charset, 'replace')
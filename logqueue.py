@@ -0,0 +1,119 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Logging that never makes the reactor wait for the disk.
+
+A QueueHandler on the logger only puts records on a queue; a QueueListener
+takes them off again in a thread of its own and passes them to the handlers
+that do the actual writing, such as a RotatingFileHandler.  Python 2 doesn't
+have these yet, they work like the ones in Python 3's logging.handlers.
+
+"""
+
+import json
+import logging
+import threading
+from Queue import Queue, Full
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue instead of writing them anywhere.
+
+    The message is formatted here, while its arguments are still what they
+    were when it was logged, but only for records that got past the
+    loggers' levels.  When the queue is full records are dropped and
+    counted rather than held up.
+
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            # Tracebacks hold on to every frame, and can't be pickled.
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': 'Dropped %d log records' % (self.dropped,)}))
+                self.dropped = 0
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Passes the records on a queue to handlers, from a thread."""
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='logging')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Handle whatever's still queued and close the handlers."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handle(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, for feeding the logs to other tools."""
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+
+def start(logger, handlers, max_queue=10000):
+    """Send everything logged to logger through a queue to handlers.
+
+    Returns the QueueListener, stop() it once the logging is done.
+
+    """
+    queue = Queue(max_queue)
+    logger.addHandler(QueueHandler(queue))
+    listener = QueueListener(queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,121 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Matching channel messages against the patterns plugs subscribed to.
+
+Plugs mark handlers with plugbase.match(pattern) instead of looking at every
+message in handle_chanmsg themselves.  The Matcher puts all of those
+patterns together in one big alternation, so most messages are dealt with by
+a single regex search that finds nothing, and only the plugs whose pattern
+matched are called.
+
+"""
+
+import re
+
+# Python's re module doesn't allow more groups than this in one pattern.
+MAX_GROUPS = 99
+
+# Patterns with backreferences by number can't go in an alternation with
+# others, their group numbers would change.  Named ones are fine.
+_BACKREF = re.compile(r'\\[1-9]')
+
+
+class Matcher(object):
+    """Finds the subscribed patterns that match a message.
+
+    `table` is the core's match dispatch table, which maps (pattern, flags,
+    channels) to the plugs subscribed to it.  channels is a tuple of the
+    channels the pattern is for, or None for all of them.  The combined
+    patterns are only rebuilt when something changed.
+
+    """
+    max_groups = MAX_GROUPS
+
+    def __init__(self, table, users):
+        self.table = table
+        self.users = users
+        # [(combined pattern or None, [(key, pattern, channels)])]
+        self._chunks = None
+        self._casemapping = None
+
+    def invalidate(self):
+        self._chunks = None
+
+    def scan(self, channel, msg):
+        """Return [(plugs, key, match)] for the patterns msg matches."""
+        chunks = self._chunks
+        if chunks is None or self._casemapping != self.users.casemapping:
+            chunks = self._chunks = self._build()
+        if not chunks:
+            return []
+        folded = self.users.fold(channel)
+        hits = []
+        for combined, entries in chunks:
+            if combined is None:
+                # A pattern that has to be searched on its own.
+                key, pattern, channels = entries[0]
+                if channels is None or folded in channels:
+                    m = pattern.search(msg)
+                    if m is not None:
+                        hits.append((self.table[key], key, m))
+                continue
+            m = combined.search(msg)
+            if m is None:
+                continue
+            # Nothing matched before m.start(), and at m.start() nothing
+            # before the pattern that did.  That leaves the rest to check
+            # from there on.
+            pos = m.start()
+            first = int(m.lastgroup[2:])
+            for i, (key, pattern, channels) in enumerate(entries):
+                if channels is not None and folded not in channels:
+                    continue
+                found = pattern.search(msg, pos if i >= first else pos + 1)
+                if found is not None:
+                    hits.append((self.table[key], key, found))
+        return hits
+
+    def _build(self):
+        self._casemapping = self.users.casemapping
+        byflags = {}
+        for key, plugs in sorted(self.table.iteritems()):
+            if not plugs:
+                continue
+            pattern, flags, channels = key
+            if channels is not None:
+                channels = frozenset(self.users.fold(channel)
+                                     for channel in channels)
+            compiled = re.compile(pattern, flags)
+            # By the flags the pattern ended up with: an inline (?x) or (?i)
+            # applies to everything it's combined with.
+            byflags.setdefault(compiled.flags, []).append(
+                (key, compiled, channels))
+        chunks = []
+        for flags, entries in sorted(byflags.iteritems()):
+            chunk, groups = [], 0
+            for entry in entries:
+                if _BACKREF.search(entry[0][0]) or \
+                        entry[1].groups >= self.max_groups:
+                    chunks.append((None, [entry]))
+                    continue
+                if groups + entry[1].groups + 1 > self.max_groups:
+                    chunks.extend(self._combine(chunk, flags))
+                    chunk, groups = [], 0
+                chunk.append(entry)
+                groups += entry[1].groups + 1
+            chunks.extend(self._combine(chunk, flags))
+        return chunks
+
+    def _combine(self, entries, flags):
+        """Return the chunks to search entries with, ideally just one."""
+        if not entries:
+            return []
+        pattern = '|'.join('(?P<_m%d>%s)' % (i, key[0])
+                           for i, (key, compiled, channels)
+                           in enumerate(entries))
+        try:
+            return [(re.compile(pattern, flags), entries)]
+        except re.error:
+            # Probably the same group name in two patterns.
+            return [(None, [entry]) for entry in entries]
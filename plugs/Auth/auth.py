@@ -1,8 +1,106 @@
 # Copyright (c) 2012 Dominic van Berkel
 # See LICENSE for details.
 
+import re
+import time
+from collections import OrderedDict
+
 from plugs import plugbase
 from util import Event
+import matching
+
+
+class NickPrefixes(object):
+    """A trie of nickname prefixes.
+
+    Finding out whether a nick starts with any of the prefixes takes at most
+    len(nick) steps, no matter how many prefixes there are.  `fold` is used
+    to normalise the case of prefixes and nicks, see users.Users.fold.
+
+    """
+    def __init__(self, prefixes, fold):
+        self.fold = fold
+        self.root = {}
+        for prefix in prefixes:
+            node = self.root
+            for char in fold(prefix):
+                node = node.setdefault(char, {})
+            # None marks the end of a prefix.
+            node[None] = True
+
+    def match(self, nickname):
+        """Does nickname start with any of the prefixes?"""
+        node = self.root
+        for char in self.fold(nickname):
+            if None in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return None in node
+
+
+class HostMasks(object):
+    """Maps hostmasks to power.
+
+    Masks can be plain hostnames ('trusted.host'), which are matched with a
+    single dict lookup, or contain * and ? wildcards.  Masks with an @ in
+    them ('*@*.example.org') are matched against user@host, masks with a !
+    against nick!user@host and the rest against just the host.  Matching is
+    case-insensitive and when several masks match, the highest power wins.
+
+    """
+    max_groups = matching.MAX_GROUPS
+
+    def __init__(self, masks):
+        self.exact = dict()
+        # [(compiled pattern, [(mask, power)])], one entry per chunk of at
+        # most max_groups masks, highest powers first.
+        self.host, self.userhost, self.full = [], [], []
+        patterned = []
+        for mask, power in masks.iteritems():
+            if any(char in mask for char in '*?@!'):
+                patterned.append((power, mask))
+            else:
+                self.exact[mask.lower()] = (mask, power)
+        patterned.sort(reverse=True)
+        shapes = {'host': [], 'userhost': [], 'full': []}
+        for power, mask in patterned:
+            if '!' in mask:
+                shapes['full'].append((mask, power))
+            elif '@' in mask:
+                shapes['userhost'].append((mask, power))
+            else:
+                shapes['host'].append((mask, power))
+        for shape, entries in shapes.iteritems():
+            compiled = getattr(self, shape)
+            for i in range(0, len(entries), self.max_groups):
+                chunk = entries[i:i + self.max_groups]
+                pattern = '|'.join('(%s)' % (self.translate(mask),)
+                                   for mask, power in chunk)
+                compiled.append((re.compile(r'(?:%s)\Z' % (pattern,),
+                                            re.IGNORECASE), chunk))
+
+    @staticmethod
+    def translate(mask):
+        """Turn a wildcard mask into a regular expression."""
+        return re.escape(mask).replace('\\*', '.*').replace('\\?', '.')
+
+    def match(self, nickname, username, hostmask):
+        """Return the (mask, power) that matches this user, or None."""
+        found = self.exact.get(hostmask.lower())
+        userhost = '%s@%s' % (username, hostmask)
+        for compiled, subject in ((self.host, hostmask),
+                                  (self.userhost, userhost),
+                                  (self.full, '%s!%s' % (nickname, userhost))):
+            for pattern, chunk in compiled:
+                m = pattern.match(subject)
+                if m is not None:
+                    candidate = chunk[m.lastindex - 1]
+                    if found is None or candidate[1] > found[1]:
+                        found = candidate
+                    break
+        return found
 
 
 class AuthPlug(plugbase.Plug):
@@ -13,29 +111,93 @@ class AuthPlug(plugbase.Plug):
     # responded to appropriately.
     manual_auths = dict()
 
+    # Defaults for when there's no plugconf/Auth.json: nobody gets any power.
+    known_nicks = []
+    users_auth = dict()
+    hosts_auth = dict()
+
+    # Minimum number of seconds between two WHOIS requests, so a mass join
+    # doesn't get the bot killed for flooding.
+    whois_delay = 1.0
+    # Number of seconds a WHOIS result (NickServ account or the lack of one)
+    # is remembered for a nick at a given user@host.
+    account_ttl = 600
+
     def load(self, startingup=True):
         """Force reloading the userlist in case the plug is reloaded"""
+        self.build_index()
+        # Nicknames waiting to be WHOISed, folded nick -> nick, in order.
+        self._whois_queue = OrderedDict()
+        # WHOIS requests that are waiting for RPL_ENDOFWHOIS, folded nick
+        # -> the account from RPL_WHOISACCOUNT or None if there wasn't one.
+        self._whois_pending = dict()
+        self._whois_call = None
+        self._last_whois = 0
+        # folded nick -> (account, username, hostmask, expiry time)
+        self._accounts = dict()
+        self._next_prune = 0
         if not startingup:
             for nick, user in self.users.users_by_nick.iteritems():
                 self.handle_usercreated(user)
 
+    def build_index(self):
+        """Compile known_nicks and hosts_auth into their lookup structures.
+
+        Has to be called again whenever those change.
+
+        """
+        self.nick_index = NickPrefixes(self.known_nicks, self.users.fold)
+        self.index_casemapping = self.users.casemapping
+        self.host_index = HostMasks(self.hosts_auth)
+
+    def reconfigure(self, changed):
+        """Apply a changed auth config to everyone, without a reload.
+
+        Power is worked out again for every user, but the account cache
+        stays, so only nicks that weren't WHOISed yet get a WHOIS.
+
+        """
+        plugbase.Plug.reconfigure(self, changed)
+        if 'known_nicks' in changed or 'hosts_auth' in changed:
+            self.build_index()
+        if set(changed) & set(['known_nicks', 'users_auth', 'hosts_auth']):
+            for user in self.users.users_by_nick.values():
+                self.authenticate(user)
+
     @plugbase.event
     def handle_usercreated(self, user):
         """A user has joined a channel, so let's give them perms."""
+        self.authenticate(user)
+
+    def authenticate(self, user, force=False):
+        """Work out the user's power from the auth config.
+
+        Hostmasks are checked right away, NickServ accounts come from the
+        account cache or, if that has nothing (or `force` is set), from a
+        queued WHOIS.
+
+        """
         user.power = 0
         user.auth_method = ''
         found = False
-        if user.hostmask in self.hosts_auth:
+        if self.index_casemapping != self.users.casemapping:
+            # The server told us about its casemapping after we were loaded.
+            self.build_index()
+        host = self.host_index.match(user.nickname, user.username,
+                                     user.hostmask)
+        if host is not None:
             found = True
-            self.powerup(user, self.hosts_auth[user.hostmask], 'hostmask', user.hostmask)
-        for nick in self.known_nicks:
-            if user.nickname.lower().startswith(nick):
-                found = True
-                self.core.sendLine('WHOIS %s' % (user.nickname,))
-                break
+            self.powerup(user, host[1], 'hostmask', host[0])
+        if self.nick_index.match(user.nickname):
+            found = True
+            if not force and getattr(user, 'restored', False) and \
+                    hasattr(user, 'account'):
+                # We already knew before the restart, no need to WHOIS.
+                self.cache_account(user.nickname, user.account)
+            self.check_account(user, force)
         if not found and user.nickname in self.manual_auths:
             # !auth attempt from unknown user
-            self.log.info('Failed authentication attempt by %s - nickname not found in auth config.' % (user.nickname,))
+            self.log.info('Failed authentication attempt by %s - nickname not found in auth config.', user.nickname)
             self.respond(user.nickname, self.manual_auths[user.nickname],
                          "%s is not in the auth file.  This incident will be reported." % user.nickname)
             del self.manual_auths[user.nickname]
@@ -43,10 +205,85 @@ class AuthPlug(plugbase.Plug):
     @plugbase.event
     def handle_userrenamed(self, user, oldnick):
         """A user has changed their nickname, let's recheck auth"""
-        for nick in self.known_nicks:
-            if user.nickname.lower().startswith(nick):
-                self.core.sendLine('WHOIS %s' % (user.nickname,))
-                break
+        # The account belongs to the person, not the nick, so it moves along.
+        old, new = self.users.fold(oldnick), self.users.fold(user.nickname)
+        cached = self._accounts.pop(old, None)
+        if cached is not None:
+            self._accounts[new] = cached
+        if old in self._whois_queue:
+            if self.nick_index.match(user.nickname):
+                # Keep its place in the queue, under the new nick.
+                self._whois_queue = OrderedDict(
+                    (new, user.nickname) if key == old else (key, nickname)
+                    for key, nickname in self._whois_queue.iteritems())
+            else:
+                del self._whois_queue[old]
+        if self.nick_index.match(user.nickname):
+            self.check_account(user)
+
+    @plugbase.event
+    def handle_userremoved(self, user):
+        """A user is gone, so don't WHOIS them anymore."""
+        self._whois_queue.pop(self.users.fold(user.nickname), None)
+
+    def check_account(self, user, force=False):
+        """Find out which NickServ account user is logged in as, if any.
+
+        Uses the account cache if it has a result for this nick at this
+        user@host, otherwise (or when `force` is set) queues a WHOIS.
+
+        """
+        cached = self._accounts.get(self.users.fold(user.nickname))
+        if (not force and cached is not None and cached[3] > time.time()
+                and cached[1:3] == (user.username, user.hostmask)):
+            self.account_found(user, cached[0])
+        else:
+            self.request_whois(user.nickname)
+
+    def account_found(self, user, account):
+        """Power up user if they're logged in to an account we know."""
+        if account in self.users_auth:
+            self.powerup(user, self.users_auth[account], 'NickServ', account)
+
+    def request_whois(self, nickname):
+        """Queue a WHOIS for nickname unless one is queued or running."""
+        key = self.users.fold(nickname)
+        if key not in self._whois_queue and key not in self._whois_pending:
+            self._whois_queue[key] = nickname
+            self._schedule_whois()
+
+    def _schedule_whois(self):
+        if self._whois_call is None and self._whois_queue:
+            delay = max(0, self._last_whois + self.whois_delay - time.time())
+            self._whois_call = self.call_later(delay, self._send_whois)
+
+    def _send_whois(self):
+        """Send the next WHOIS in the queue and schedule the one after."""
+        self._whois_call = None
+        if not self._whois_queue:
+            # Everyone who was waiting left.
+            return
+        key, nickname = self._whois_queue.popitem(last=False)
+        self._whois_pending[key] = None
+        self._last_whois = time.time()
+        self.core.sendLine('WHOIS %s' % (nickname,))
+        self._schedule_whois()
+
+    def cache_account(self, nickname, account):
+        """Remember which account nickname is logged in as (None for none)."""
+        now = time.time()
+        if now > self._next_prune:
+            # Throw out expired entries every now and then so the cache
+            # doesn't grow forever.
+            for key, cached in self._accounts.items():
+                if cached[3] < now:
+                    del self._accounts[key]
+            self._next_prune = now + self.account_ttl
+        user = self.users.by_nick(nickname)
+        if user is not None:
+            user.account = account
+            self._accounts[self.users.fold(nickname)] = (account,
+                user.username, user.hostmask, now + self.account_ttl)
 
     def powerup(self, user, power, auth_method, auth_match):
         """Set user's power, log and act on `self.manual_auths` if necessary.
@@ -63,17 +300,29 @@ class AuthPlug(plugbase.Plug):
             self.respond(user.nickname, self.manual_auths[user.nickname], "Successfully authenticated %s"
                 % user.nickname)
             del self.manual_auths[user.nickname]
-        self.log.info('Power of %s set to %d based on %s: %s'
-                % (user.nickname, user.power, auth_method, auth_match))
+        self.log.info('Power of %s set to %d based on %s: %s',
+                user.nickname, user.power, auth_method, auth_match)
 
     @plugbase.raw('330')
     def handle_loggedinas(self, command, prefix, params):
         """Act on Freenode's 'Logged in as:' response in the WHOIS reply."""
         nickname = params[1]
         account = params[2]
-        if account in self.users_auth:
-            user = self.users.by_nick(nickname)
-            self.powerup(user, self.users_auth[account], 'NickServ', account)
+        key = self.users.fold(nickname)
+        if key in self._whois_pending:
+            self._whois_pending[key] = account
+        self.cache_account(nickname, account)
+        user = self.users.by_nick(nickname)
+        if user is not None:
+            self.account_found(user, account)
+
+    @plugbase.raw('318')
+    def handle_endofwhois(self, command, prefix, params):
+        """A WHOIS is done, remember if it didn't turn up an account."""
+        key = self.users.fold(params[1])
+        if key in self._whois_pending:
+            if self._whois_pending.pop(key) is None:
+                self.cache_account(params[1], None)
 
     @plugbase.command()
     def cmd_auth(self, source, target, argv):
@@ -81,7 +330,7 @@ class AuthPlug(plugbase.Plug):
         user = self.users.by_nick(source)
         if user is not None:
             self.manual_auths[source] = target
-            self.handle_usercreated(user)
+            self.authenticate(user, force=True)
 
     @plugbase.command()
     def cmd_whoami(self, source, target, argv):
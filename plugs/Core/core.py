@@ -17,6 +17,7 @@ class CorePlug(plugbase.Plug):
     name = 'Core'
 
     @plugbase.command()
+    @plugbase.cached(ttl=300)
     def cmd_commands(self, source, target, argv):
         """List registered commands."""
         # Only list those commands that have any plugs
@@ -26,6 +27,7 @@ class CorePlug(plugbase.Plug):
         self.respond(source, target, response)
 
     @plugbase.command()
+    @plugbase.cached(ttl=300)
     def cmd_plugs(self, source, target, argv):
         """List the loaded plugs"""
         response = ', '.join(self.core.plugs)
@@ -41,35 +43,43 @@ class CorePlug(plugbase.Plug):
         """Quit in order to restart"""
         self.core.shutdown('Requested by ' + source, restart=True)
 
-    @plugbase.command(level=12)
+    @plugbase.command(level=12, args=0)
     def cmd_raw(self, source, target, argv):
-        """Send a raw message to the server."""
+        """Send a raw message to the server, spacing and all."""
         self.core.sendLine(' '.join(argv[1:]))
 
     @plugbase.command(level=12)
     def cmd_reload(self, source, target, argv):
-        """Reload specified modules."""
+        """Reload specified modules.
+
+        Loaded plugs are reloaded in place if their code changed, keeping
+        their state.  With -f they're replaced by a new instance instead.
+
+        """
+        full = '-f' in argv[1:]
+        # keep core safe in case this plug is being replaced, which clears
+        # self.core
+        core = self.core
         for plugname in argv[1:]:
-            # keep core safe in case this plug is being reloaded, which
-            # clears self.core
-            core = self.core
+            if plugname == '-f':
+                continue
             try:
-                core.remove_plug(plugname)
-            except KeyError:
-                self.log.warning('Tried to remove unknown plug %s.'
-                    % (plugname,))
+                if not full and plugname in core.plugs:
+                    if core.reload_plug(plugname):
+                        message = 'Reloaded %s.'
+                    else:
+                        message = '%s is up to date.'
+                else:
+                    core.load_plug(plugname)
+                    message = 'Loaded %s.'
+            except (ImportError, SyntaxError):
+                self.log.exception('Failed to import %s.', plugname)
+                message = 'Failed to import %s.'
             self.core = core
-            try:
-                core.load_plug(plugname)
-            except ImportError:
-                self.respond(source, target, 'Failed to import %s.'
-                    % (plugname,))
-            else:
-                self.respond(source, target, 'Loaded %s.'
-                    % (plugname,))
-            finally:
-                if plugname == 'Core':
-                    del self.core
+            self.respond(source, target, message % (plugname,))
+        if core.plugs.get(self.name) is not self:
+            # This instance has been replaced.
+            self.core = None
 
     @plugbase.command(level=15)
     def cmd_hooks(self, source, target, argv):
@@ -81,6 +91,28 @@ class CorePlug(plugbase.Plug):
         for ev, hooks in self.core.hooks.iteritems():
             print ev, hooks
 
+    @plugbase.command(level=15)
+    def cmd_profile(self, source, target, argv):
+        """Profile line handling and plug dispatch for a number of seconds.
+
+        Results go to a file in profile_dir, a summary is sent back when
+        it's done.
+
+        """
+        try:
+            seconds = float(argv[1])
+        except (IndexError, ValueError):
+            self.respond(source, target, 'Usage: profile <seconds>')
+            return
+        seconds = min(max(seconds, 1), 3600)
+        def done(summary):
+            for line in summary:
+                self.respond(source, target, line)
+        if self.core.start_profiling(seconds, done):
+            self.respond(source, target, 'Profiling for %ds.' % (seconds,))
+        else:
+            self.respond(source, target, 'Already profiling.')
+
     @plugbase.command(level=1)
     def cmd_ping(self, source, target, argv):
         """Are you still there?"""
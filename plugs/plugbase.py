@@ -3,12 +3,64 @@
 
 """Plugin base for Shirk."""
 
-import json
+import re
+import threading
+from contextlib import contextmanager
 from functools import wraps
+
+from twisted.internet import defer, reactor, threads
+
 from util import Event
+import cache
+import confstore
+
+# Which Shirk instance is being served right now, for plugs that are shared
+# between networks.  See current_core().
+_context = threading.local()
+
+
+@contextmanager
+def current_core(core):
+    """Make shared plugs see `core` as self.core for the duration.
+
+    The core wraps everything that comes from its connection in this, so a
+    plug that's shared between networks (shirk.Networks) answers on the
+    network that's talking to it.
+
+    """
+    previous = getattr(_context, 'core', None)
+    _context.core = core
+    try:
+        yield
+    finally:
+        _context.core = previous
+
+
+def _call_with_core(core, f, *args):
+    with current_core(core):
+        return f(*args)
+
+
+def _call_method(plug, name, args, kw):
+    """Call plug's method called name, whatever its class is by now."""
+    return getattr(plug, name)(*args, **kw)
+
+
+def _threaded(f):
+    """Make the decorated handler run in the core's thread pool.
+
+    Used by the `threaded` option of the decorators below, see
+    Plug.run_in_thread.
+
+    """
+    @wraps(f)
+    def newf(self, *args):
+        return self.run_in_thread(f, self, *args)
+    return newf
 
 
-def command(trigger=None, level=0):
+def command(trigger=None, level=0, threaded=False, aliases=(), args=None,
+            cost=1):
     """Mark the decorated function as a !command handler.
 
     :param trigger: The !command that should trigger this handler.  For
@@ -18,24 +70,129 @@ def command(trigger=None, level=0):
                     !foo.
     :param level: The required user level for this handler.  Depends on the
                   Auth plug.
+    :param threaded: Run the handler in a thread so it can block without
+                     holding up the bot.  The level check still happens on
+                     the reactor.  If the handler returns a string, that is
+                     sent as a response.
+    :param aliases: Other names for the command, like ('h',) for !help.
+    :param args: How to split up the arguments.  By default they're split on
+                 whitespace.  A number n splits off at most n arguments and
+                 leaves the rest of the line as the last one, and a function
+                 is called with the rest of the line after the command and
+                 returns the list of arguments.  If it raises ValueError,
+                 the message is sent back instead of calling the handler.
+                 Either way the handler gets [command] + the arguments.
+    :param cost: How much the command counts towards the user's and
+                 channel's flood limits, see commands.FloodGuard.
 
     """
+    if args is None:
+        parse = None
+    elif callable(args):
+        parse = args
+    else:
+        parse = lambda rest: rest.split(None, args)
     def decorator(f):
+        if threaded:
+            run = _threaded_command(f)
+        else:
+            run = f
         @wraps(f)
         def newf(self, source, target, argv):
             user = self.users.by_nick(source)
             if user and user.power >= level:
-                f(self, source, target, argv)
+                if parse is not None:
+                    rest = getattr(argv, 'rest', None)
+                    if rest is None:
+                        rest = ' '.join(argv[1:])
+                    try:
+                        argv = [argv[0]] + list(parse(rest))
+                    except ValueError as e:
+                        self.respond(source, target, '%s: %s' % (argv[0], e))
+                        return
+                run(self, source, target, argv)
         if trigger is None:
             cmd = f.func_name.split('_', 1)[1]
         else:
             cmd = trigger
         newf._shirk_command = cmd
+        newf._shirk_aliases = tuple(aliases)
+        newf._shirk_cost = cost
         return newf
     return decorator
 
 
-def raw(code=None):
+def cached(ttl=60, maxsize=100, per_channel=False):
+    """Remember what the decorated command handler responds with.
+
+    Goes between command() and the handler:
+
+        @plugbase.command()
+        @plugbase.cached(ttl=300)
+        def cmd_foo(self, source, target, argv):
+
+    The next time the same command is given with the same arguments, the
+    responses are sent again without calling the handler, until `ttl`
+    seconds have passed or plugs were loaded or unloaded (see
+    Shirk.generation).  Only for handlers whose answer doesn't depend on who
+    asks, and not for threaded ones.
+
+    :param ttl: Seconds a response is good for.
+    :param maxsize: How many different argument lists to remember.
+    :param per_channel: Whether the answer depends on the channel.  Private
+                        messages count as a channel of their own.
+
+    """
+    def decorator(f):
+        name = f.func_name
+        @wraps(f)
+        def newf(self, source, target, argv):
+            key = tuple(argv)
+            if per_channel:
+                key = (target,) + key
+            if self._response_cache is None:
+                self._response_cache = cache.ResponseCache(
+                    self.cache_max_bytes)
+            core = self.core
+            responses = self._response_cache.get(name, key, core)
+            if responses is not None:
+                for msg, rkey, rttl in responses:
+                    self.respond(source, target, msg, rkey, rttl)
+                return
+            responses = []
+            respond = self.respond
+            def record(source, target, msg, key=None, ttl=None):
+                responses.append((msg, key, ttl))
+                respond(source, target, msg, key, ttl)
+            self.respond = record
+            try:
+                result = f(self, source, target, argv)
+            finally:
+                del self.respond
+            # Nothing to go on if the answer comes later, or not at all.
+            if responses and not isinstance(result, defer.Deferred):
+                self._response_cache.put(name, key, core, ttl, maxsize,
+                                         responses)
+        return newf
+    return decorator
+
+
+def _threaded_command(f):
+    """Like _threaded(), but respond with whatever string f returns."""
+    @wraps(f)
+    def newf(self, source, target, argv):
+        d = self.run_in_thread(f, self, source, target, argv)
+        if d is not None:
+            d.addCallback(_respond_with, self, source, target)
+    return newf
+
+
+def _respond_with(result, plug, source, target):
+    if result is not None:
+        plug.respond(source, target, result)
+
+
+def raw(code=None, threaded=False):
     """Mark the decorated function as a handler for a raw IRC command.
 
     :param code: The command that should trigger this function.  Can be either
@@ -43,6 +200,7 @@ def raw(code=None):
                  numerical ('433', '318'), but is always a string.
                  When not provided, a function named *_<code> (e.g. handle_330)
                  will be triggered for <code> ('330').
+    :param threaded: Run the handler in a thread, see command().
 
     """
     def decorator(f):
@@ -50,19 +208,58 @@ def raw(code=None):
             cmd = f.func_name.split('_', 1)[1]
         else:
             cmd = code
+        if threaded:
+            f = _threaded(f)
         f._shirk_raw = cmd
         return f
     return decorator
 
 
-def event(f):
+def match(pattern, channels=None, flags=0, threaded=False):
+    """Mark the decorated function as a handler for channel messages that
+    match a regular expression.
+
+    The handler is called as handler(source, channel, msg, action, match),
+    with the first four like for handle_chanmsg and match the re match
+    object.  Messages are checked against all plugs' patterns in one go
+    (see matching.Matcher), which is a lot cheaper than every plug
+    searching every message in handle_chanmsg.
+
+    :param pattern: The regular expression, which may match anywhere in the
+                    message.
+    :param channels: The channels to match messages in, all of them when
+                     None.
+    :param flags: re flags for the pattern, like re.IGNORECASE.
+    :param threaded: Run the handler in a thread, see command().
+
+    """
+    # Find out about broken patterns when the plug is imported.
+    re.compile(pattern, flags)
+    if channels is not None:
+        channels = tuple(channels)
+    def decorator(f):
+        if threaded:
+            f = _threaded(f)
+        f._shirk_match = (pattern, flags, channels)
+        return f
+    return decorator
+
+
+def event(f=None, threaded=False):
     """Mark the decorated function as a handler for an event as defined in
     util.Event.
 
     The function name should match *_<eventname>, where <eventname> is one of
     the constants in util.Event.
 
+    Can be used as @event, or as @event(threaded=True) to run the handler in
+    a thread (see command()).
+
     """
+    if f is None:
+        return lambda f: event(f, threaded)
+    if threaded:
+        f = _threaded(f)
     # Remark: The addition of this decorator pretty much makes util.Event
     # obsolete.  This is on purpose: the event system is up for a rewrite
     # anyway, as described in <https://github.com/barometz/shirk/issues/10>.
@@ -75,13 +272,133 @@ def event(f):
     return f
 
 
+class LazyPlug(object):
+    """Stand-in for a plug that hasn't been imported yet.
+
+    Plugs with a manifest.json in their directory that says `"lazy": true`
+    aren't imported at startup.  Instead one of these hooks the commands,
+    raw IRC commands and events listed in the manifest, for instance:
+
+        {"lazy": true, "commands": ["foo"], "aliases": {"foo": ["f"]},
+         "raw": ["330"], "events": ["usercreated"]}
+
+    and has the core load the real plug the first time any of them fires,
+    then passes that first call on to it.  Anything the real plug hooks that
+    the manifest doesn't list is logged when it loads, since it couldn't
+    have fired before that.
+
+    """
+    def __init__(self, core, plugname, manifest):
+        self.name = plugname
+        self.core = core
+        self.manifest = manifest
+
+    def __repr__(self):
+        return '<LazyPlug %s>' % (self.name,)
+
+    def hook_events(self):
+        aliases = self.manifest.get('aliases', {})
+        for cmd in self.manifest.get('commands', ()):
+            self.core.add_command(cmd, self, aliases.get(cmd, ()))
+        for cmd in self.manifest.get('raw', ()):
+            self.core.add_raw(cmd, self)
+        for event in self.manifest.get('events', ()):
+            self.core.add_callback(getattr(Event, event), self)
+
+    def cleanup(self):
+        pass
+
+    def __getattr__(self, name):
+        """Load the real plug and hand it whatever handle_* is called."""
+        if not name.startswith('handle_'):
+            raise AttributeError(name)
+        def forward(*args):
+            core = self.core
+            core.log.info('Loading lazy plug %s for %s', self.name, name)
+            try:
+                plug = core.load_plug(self.name)
+            except ImportError:
+                core.log.exception('Failed to load plug %s.', self.name)
+                return
+            self.check_manifest(plug)
+            getattr(plug, name)(*args)
+        return forward
+
+    def check_manifest(self, plug):
+        """Log the hooks of the real plug that the manifest leaves out."""
+        manifest = self.manifest
+        commands = set(manifest.get('commands', ()))
+        aliases = manifest.get('aliases', {})
+        raws = set(manifest.get('raw', ()))
+        events = set(getattr(Event, event)
+                     for event in manifest.get('events', ()))
+        missing = []
+        for cmd, handler in sorted(plug._commands.iteritems()):
+            if cmd not in commands:
+                missing.append('command %s' % (cmd,))
+            for alias in handler._shirk_aliases:
+                if alias not in aliases.get(cmd, ()):
+                    missing.append('alias %s' % (alias,))
+        missing.extend('raw %s' % (cmd,)
+                       for cmd in sorted(set(plug._rawhooks) - raws))
+        missing.extend('event %s' % (event,)
+                       for event in sorted(set(plug._eventhooks) - events))
+        missing.extend('match %s' % (key[0],)
+                       for key in sorted(plug._matches))
+        if missing:
+            self.core.log.warning('manifest.json for %s is missing: %s',
+                                  self.name, ', '.join(missing))
+
+
+class PlugMeta(type):
+    """Metaclass for plugs that finds the handlers once per class.
+
+    Stores a tuple of (attribute name, marker, trigger) in
+    `cls._shirk_handlers`, where marker is the `_shirk_*` attribute the
+    decorators above set and trigger is its value.
+
+    """
+    markers = ('_shirk_command', '_shirk_raw', '_shirk_event',
+               '_shirk_match')
+
+    def __init__(cls, name, bases, attrs):
+        super(PlugMeta, cls).__init__(name, bases, attrs)
+        handlers = []
+        for name in dir(cls):
+            # Ignore `__*` attributes because there are plenty of those and
+            # hasattr() isn't free.
+            if name.startswith('__'):
+                continue
+            attr = getattr(cls, name)
+            for marker in cls.markers:
+                if hasattr(attr, marker):
+                    handlers.append((name, marker, getattr(attr, marker)))
+                    break
+        cls._shirk_handlers = tuple(handlers)
+
+
 class Plug(object):
     """Base class for Shirk plugs.
 
     Specifies some utility functions and glue between core and plug.
 
     """
+    __metaclass__ = PlugMeta
     name = "Plug"
+    # Limits for handlers that run in threads: at most max_threads of this
+    # plug's handlers run at the same time, and when max_thread_queue more
+    # are waiting for their turn any further calls are dropped.
+    max_threads = 2
+    max_thread_queue = 20
+    # Set by the core on plugs that are shared between networks.  Those find
+    # out which network they're serving through current_core().
+    shared = False
+    # Roughly how many bytes of responses all of this plug's cached()
+    # handlers may keep together.
+    cache_max_bytes = 64 * 1024
+    _response_cache = None
+    _store = None
+    _timers = None
 
     def __init__(self, core, startingup=True):
         """Create a new Plug instance.  
@@ -96,68 +413,155 @@ class Plug(object):
         """
         # `self._commands` is a dictionary of "foo": function, where !foo will
         # trigger the function to be called.  Similar for `_rawhooks` and
-        # `_eventhooks`.
+        # `_eventhooks`, and `_matches` is keyed by (pattern, flags, channels)
+        # as set up by match().
         self._commands = dict()
         self._rawhooks = dict()
         self._eventhooks = dict()
+        self._matches = dict()
+        self._thread_semaphore = None
+        self._thread_waiting = 0
         self.log = core.log.getChild(self.name)
         self.log.info("Loading")
         self.core = core
-        self.users = core.users
         self.load_config()
         self.load(startingup)
 
+    @property
+    def core(self):
+        """The Shirk instance this plug is serving right now."""
+        if self.shared:
+            core = getattr(_context, 'core', None)
+            if core is not None:
+                return core
+        return self._core
+
+    @core.setter
+    def core(self, core):
+        self._core = core
+
+    @property
+    def users(self):
+        return self.core.users
+
+    @property
+    def store(self):
+        """The plug's persistent key/value store, see store.PlugStore.
+
+        Use it like a dict of strings to anything json can handle.  Writes
+        are saved in the background, a few seconds later at most.
+
+        """
+        store = self._store
+        if store is None or self.shared:
+            # Shared plugs get the store of the network they're serving.
+            store = self._store = self.core.open_store(self.name)
+        return store
+
     def load_config(self):
-        """Load configuration from conf.json in the plug's directory.
+        """Load configuration from plugconf/{self.name}.json.
 
-        Tries to load plugs/{self.name}/conf.json and adds all key/value pairs
-        in there as attributes to the plug instance.
+        Adds all key/value pairs in there as attributes to the plug
+        instance.  The file comes from the core's ConfigStore, so it's only
+        parsed once however many plugs use it.
 
         """
-        configfile = 'plugconf/%s.json' % (self.name,)
-        try:
-            config = json.load(open(configfile))
-        except IOError:
-            self.log.info('No config file found at %s.' % (configfile,))
-            pass
+        config = self.core.confstore.get(self.name)
+        if not config:
+            self.log.info('No config found for %s.', self.name)
         else:
-            self.log.info('Loading config file %s.' % (configfile,))
+            self.log.info('Loading config for %s.', self.name)
             for k, v in config.iteritems():
                 setattr(self, k, v)
 
+    def reconfigure(self, changed):
+        """Apply the keys in the plug's config file that changed.
+
+        `changed` maps each key that changed to its new value, or to
+        confstore.DELETED if it was removed, in which case the class default
+        applies again.  Override this to act on a change, like rebuilding
+        an index, rather than having to be reloaded; call this first.
+
+        """
+        for k, v in changed.iteritems():
+            if v is confstore.DELETED:
+                self.__dict__.pop(k, None)
+            else:
+                setattr(self, k, v)
+
     def load(self, startingup=True):
         pass
 
+    def reloaded(self):
+        """Called after Shirk.reload_plug gave the plug its new class.
+
+        load() isn't run again then, though the plug is loaded from scratch
+        instead if load() itself changed.  Override this to fix up state
+        that the new code expects some other way.
+
+        """
+        pass
+
+    def collect_handlers(self):
+        """Bind the handlers PlugMeta found for this plug's class."""
+        self._commands = dict()
+        self._rawhooks = dict()
+        self._eventhooks = dict()
+        self._matches = dict()
+        tables = {'_shirk_command': self._commands,
+                  '_shirk_raw': self._rawhooks,
+                  '_shirk_event': self._eventhooks,
+                  '_shirk_match': self._matches}
+        for name, marker, trigger in self._shirk_handlers:
+            self.log.debug('Registering handler %s for %s %s',
+                           name, marker[len('_shirk_'):], trigger)
+            tables[marker][trigger] = getattr(self, name)
+
     def hook_events(self):
         """Ask the core to add whatever callbacks have been specified."""
-        # Collect handlers by checking all the plug's attributes for relevant
-        # metadata
-        for name in dir(self):
-            attr = getattr(self, name)
-            # Ignore `__*` attributes because there are plenty of those and
-            # hasattr() isn't free.  Then see whether the attribute has a
-            # ._shirk_<whatever>, if so then use it.
-            if not name.startswith('__'):
-                if hasattr(attr, '_shirk_command'):
-                    self.log.debug('Registering handler %s for command %s'
-                                   % (attr, attr._shirk_command))
-                    self._commands[attr._shirk_command] = attr
-                elif hasattr(attr, '_shirk_raw'):
-                    self.log.debug(
-                        'Registering handler %s for raw IRC command %s'
-                        % (attr, attr._shirk_raw))
-                    self._rawhooks[attr._shirk_raw] = attr
-                elif hasattr(attr, '_shirk_event'):
-                    self.log.debug('Registering handler %s for event %s'
-                                   % (attr, attr._shirk_event))
-                    self._eventhooks[attr._shirk_event] = attr
+        self.collect_handlers()
         # Now prod the core to actually register things
-        for cmd in self._commands:
-            self.core.add_command(cmd, self)
+        for cmd, handler in self._commands.iteritems():
+            self.core.add_command(cmd, self, handler._shirk_aliases,
+                                  handler._shirk_cost)
         for event in self._eventhooks:
             self.core.add_callback(event, self)
         for cmd in self._rawhooks:
             self.core.add_raw(cmd, self)
+        for key in self._matches:
+            self.core.add_match(key, self)
+
+    def rehook_events(self):
+        """Update the core's hooks after the plug's class was swapped out.
+
+        Only hooks for triggers that were added or removed are touched, the
+        rest keep pointing at this plug and simply pick up the new code.
+
+        """
+        old_commands = set(self._commands)
+        old_rawhooks = set(self._rawhooks)
+        old_events = set(self._eventhooks)
+        old_matches = set(self._matches)
+        self.collect_handlers()
+        for cmd in old_commands.difference(self._commands):
+            self.core.remove_hook(Event.command, self, cmd)
+        for cmd in old_rawhooks.difference(self._rawhooks):
+            self.core.remove_hook(Event.raw, self, cmd)
+        for event in old_events.difference(self._eventhooks):
+            self.core.remove_hook(event, self)
+        for key in old_matches.difference(self._matches):
+            self.core.remove_hook(Event.match, self, key)
+        for cmd, handler in self._commands.iteritems():
+            # Also for the commands that were there already, their aliases
+            # or cost may have changed.
+            self.core.add_command(cmd, self, handler._shirk_aliases,
+                                  handler._shirk_cost)
+        for cmd in set(self._rawhooks).difference(old_rawhooks):
+            self.core.add_raw(cmd, self)
+        for event in set(self._eventhooks).difference(old_events):
+            self.core.add_callback(event, self)
+        for key in set(self._matches).difference(old_matches):
+            self.core.add_match(key, self)
 
     def cleanup(self):
         """Clean up any potential circular references etc.
@@ -166,9 +570,83 @@ class Plug(object):
 
         """
         self.log.info("Cleanup")
+        if self._response_cache is not None:
+            self._response_cache.clear()
+        if self._store is not None:
+            self._store.flush()
+        if self._timers:
+            for timer in list(self._timers):
+                timer.cancel()
         self.core = None
 
-    def respond(self, source, target, msg):
+    def call_later(self, delay, f, *args, **kw):
+        """Call f(*args, **kw) in `delay` seconds.
+
+        Returns a timers.Timer that can be cancelled.  Timers go on the
+        core's timing wheel rather than straight into the reactor, so lots
+        of them are cheap, and whatever's still pending is cancelled when
+        the plug is cleaned up.  They're accurate to a tenth of a second.
+        When f is one of the plug's own methods it's looked up again every
+        time the timer fires, so reloaded code takes over pending timers.
+
+        """
+        return self._schedule(delay, None, f, args, kw)
+
+    def call_every(self, interval, f, *args, **kw):
+        """Call f(*args, **kw) every `interval` seconds, see call_later.
+
+        The first call is `interval` seconds from now.
+
+        """
+        return self._schedule(interval, interval, f, args, kw)
+
+    def _schedule(self, delay, interval, f, args, kw):
+        if self._timers is None:
+            self._timers = set()
+        name = getattr(f, '__name__', None)
+        if name is not None and getattr(self, name, None) == f:
+            # The plug's own method is looked up when the timer fires, so
+            # it's the new code after Shirk.reload_plug.
+            f, args, kw = _call_method, (self, name, args, kw), {}
+        return self.core.timers.schedule(delay, interval, f, args, kw,
+                                         self._timers)
+
+    def run_in_thread(self, f, *args):
+        """Call f(*args) in the core's thread pool.
+
+        Respects max_threads and max_thread_queue.  Returns a Deferred that
+        fires on the reactor thread with f's result, or None if the call was
+        dropped because too many were waiting already.  Errors are logged.
+
+        Calling respond or the core's sendLine/msg from the thread is fine,
+        those are passed back to the reactor.  Most other things (like
+        self.users) are not safe to touch from a thread.
+
+        """
+        if self._thread_waiting >= self.max_thread_queue:
+            self.log.warning('Dropping call to %s, %d calls are waiting',
+                f.__name__, self._thread_waiting)
+            return None
+        if self._thread_semaphore is None:
+            self._thread_semaphore = defer.DeferredSemaphore(self.max_threads)
+        self._thread_waiting += 1
+        # The thread may only start once the reactor has moved on to another
+        # network, so hang on to this one.
+        d = self._thread_semaphore.run(self._start_thread, self.core, f,
+                                       *args)
+        d.addErrback(self._thread_failed, f)
+        return d
+
+    def _start_thread(self, core, f, *args):
+        self._thread_waiting -= 1
+        return threads.deferToThreadPool(reactor, core.threadpool,
+                                         _call_with_core, core, f, *args)
+
+    def _thread_failed(self, failure, f):
+        self.log.error('Error in threaded handler %s: %s',
+            f.__name__, failure.getTraceback())
+
+    def respond(self, source, target, msg, key=None, ttl=None):
         """Figures out where a reply should be sent to and sends it.
 
         A reply to a channel message is sent to the channel, which is the
@@ -178,11 +656,16 @@ class Plug(object):
         source and target refer to the original message that is being
         responded to.
 
+        Long messages are split up by the core.  If the reply is only useful
+        for a while, pass `ttl` (in seconds) and it'll be dropped if it's
+        still queued by then.  A reply with a `key` replaces any queued reply
+        with the same key, for output that supersedes itself.
+
         """
         if target.startswith('#'):
-            self.core.msg(target, msg)
+            self.core.msg(target, msg, key=key, ttl=ttl)
         else:
-            self.core.msg(source, msg)
+            self.core.msg(source, msg, key=key, ttl=ttl)
 
     def handle_addressed(self, source, target, message):
         """Called when the bot is directly addressed by a user."""
@@ -206,6 +689,22 @@ doesn\'t override it.')
         else:
             self.unhandled_cmd(source, target, argv)
 
+    def handle_match(self, source, channel, msg, action, key, match):
+        """Call the match() handler for key with the match.
+
+        match is None when it comes from the core through a worker process
+        (see workers.py), then the pattern is searched again here.
+
+        """
+        handler = self._matches.get(key)
+        if handler is None:
+            return
+        if match is None:
+            match = re.search(key[0], msg, key[1])
+            if match is None:
+                return
+        handler(source, channel, msg, action, match)
+
     def handle_private(self, source, msg, action):
         """Called when the bot receives a private message"""
         self.log.warning('handle_private has been triggered, but the plug \
@@ -216,11 +715,31 @@ doesn\'t override it.')
         self.log.warning('handle_userjoined has been triggered, but the plug \
 doesn\'t override it.')
 
+    def handle_usersjoined(self, nicknames, channel):
+        """Called with a batch of users that have been seen in a channel.
+
+        Plugs that don't handle this get handle_userjoined for every user in
+        the batch instead.
+
+        """
+        self.log.warning('handle_usersjoined has been triggered, but the \
+plug doesn\'t override it.')
+
     def handle_usercreated(self, user):
         """Called when a new user is added to the Users instance."""
         self.log.warning('handle_usercreated has been triggered, but the \
 plug doesn\'t override it.')
 
+    def handle_userscreated(self, users):
+        """Called with a batch of new users added to the Users instance.
+
+        Plugs that don't handle this get handle_usercreated for every user in
+        the batch instead.
+
+        """
+        self.log.warning('handle_userscreated has been triggered, but the \
+plug doesn\'t override it.')
+
     def handle_userremoved(self, user):
         """Called when a user is removed from the Users instance."""
         self.log.warning('handle_userremoved has been triggered, but the \
@@ -250,8 +769,8 @@ plug doesn\'t override it.')
         without specifying the appropriate cmd_<command> function.
 
         """
-        self.log.warning('Received unhandled command: %s > %s %r'
-            % (source, target, argv))
+        self.log.warning('Received unhandled command: %s > %s %r',
+            source, target, argv)
 
     def unhandled_raw(self, command, prefix, params):
         """Called for unhandled raw stuff.
@@ -260,5 +779,5 @@ plug doesn\'t override it.')
         without specifying the appropriate raw_<command> function.
 
         """
-        self.log.warning('Received unhandled raw: %s %s %r'
-            % (prefix, command, params))
+        self.log.warning('Received unhandled raw: %s %s %r',
+            prefix, command, params)
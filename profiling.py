@@ -0,0 +1,103 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""On-demand profiling of Shirk's line handling and event dispatch."""
+
+import cProfile
+import os
+import pstats
+import time
+
+import plugs
+
+# Plug code lives in plugs/<name>/, the dispatch code that calls into it
+# lives in these files.
+PLUGDIR = os.path.dirname(os.path.abspath(plugs.__file__))
+DISPATCHERS = ('shirk.py', 'plugbase.py')
+
+
+class DispatchProfiler(object):
+    """Collects a cProfile of whatever is passed through wrap()."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.calls = 0
+        # Wrapped functions call each other (lineReceived -> event_*), only
+        # the outermost one turns the profiler on and off.
+        self.depth = 0
+
+    def run(self, f, *args):
+        """Call f(*args) with profiling enabled."""
+        if self.depth:
+            return f(*args)
+        self.calls += 1
+        self.depth += 1
+        self.profile.enable()
+        try:
+            return f(*args)
+        finally:
+            self.profile.disable()
+            self.depth -= 1
+
+    def wrap(self, f):
+        """Return a function that calls f under the profiler."""
+        def profiled(*args):
+            return self.run(f, *args)
+        return profiled
+
+    def handlers(self):
+        """Break the profile down by plug and handler.
+
+        Handlers are the functions in a plug's directory that were called
+        straight from the dispatch code.  Returns {plug: [(cumulative time,
+        calls, handler name)]}, slowest handlers first.
+
+        """
+        stats = pstats.Stats(self.profile).stats
+        byplug = {}
+        for (filename, line, name), (cc, nc, tt, ct, callers) in \
+                stats.iteritems():
+            path = os.path.abspath(filename)
+            if not path.startswith(PLUGDIR + os.sep):
+                continue
+            plugname = path[len(PLUGDIR) + 1:].split(os.sep, 1)[0]
+            if plugname.endswith('.py'):
+                # plugs/plugbase.py and friends aren't plugs.
+                continue
+            if any(os.path.basename(caller[0]) in DISPATCHERS
+                   for caller in callers):
+                byplug.setdefault(plugname, []).append((ct, nc, name))
+        for handlers in byplug.itervalues():
+            handlers.sort(reverse=True)
+        return byplug
+
+    def report(self, path, top=20):
+        """Write the results to path.pstats and path.txt.
+
+        The .pstats file can be loaded with the pstats module, the .txt file
+        has the per-plug breakdown followed by the top functions.  Returns a
+        short summary as a list of strings.
+
+        """
+        elapsed = time.time() - self.started
+        self.profile.dump_stats(path + '.pstats')
+        byplug = self.handlers()
+        totals = sorted(((sum(ct for ct, nc, name in handlers), plugname)
+                         for plugname, handlers in byplug.iteritems()),
+                        reverse=True)
+        with open(path + '.txt', 'w') as f:
+            f.write('%d calls in %.1fs\n\n' % (self.calls, elapsed))
+            for total, plugname in totals:
+                f.write('%s: %.3fs\n' % (plugname, total))
+                for ct, nc, name in byplug[plugname]:
+                    f.write('    %-30s %8d calls %10.3fs\n' % (name, nc, ct))
+            f.write('\n')
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(top)
+        summary = ['Profiled %d calls in %.1fs, see %s.txt'
+                   % (self.calls, elapsed, path)]
+        if totals:
+            summary.append('Plugs: ' + ', '.join('%s %.1fms' % (plugname,
+                total * 1000) for total, plugname in totals[:5]))
+        return summary
@@ -0,0 +1,273 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Capture of raw IRC traffic, and reading it back.
+
+A Recorder writes every line the bot receives and sends to gzipped capture
+files, from a thread of its own so the reactor never waits for the disk.
+read_capture() streams the records back out of such a file and replay() feeds
+them to a Shirk instance at the original speed or faster, to reproduce load
+or bugs offline.
+
+A capture file is a gzip stream of records, each of which is a RECORD header
+(timestamp, direction, length of the line) followed by the raw line without
+its line ending.  Timestamps never go backwards within a Recorder, even when
+the system clock does.
+
+"""
+
+import gzip
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from Queue import Queue, Empty, Full
+
+from twisted.internet import defer, reactor
+
+RECORD = struct.Struct('>dcI')
+INBOUND = 'i'
+OUTBOUND = 'o'
+SUFFIX = '.cap.gz'
+
+
+class Recorder(object):
+    """Writes lines to rotating capture files in `directory`.
+
+    A new file is started when the current one has `max_bytes` of
+    uncompressed data in it or is older than `max_age` seconds, and only the
+    newest `keep` files are kept around.  When the writer thread falls
+    behind by more than `max_queue` lines, lines are dropped rather than
+    held in memory and the number dropped is logged.
+
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_age=3600,
+                 keep=24, max_queue=100000, log=None):
+        self.log = (log or logging.getLogger('shirk')).getChild('Recorder')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.queue = Queue(max_queue)
+        self.last = 0
+        # Counted by the reactor thread and reset by the writer thread.
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.sequence = 0
+        self.thread = None
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = threading.Thread(target=self._run, name='recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Write out whatever's still queued and close the file."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record(self, direction, line):
+        """Queue a line for writing.  Doesn't block, ever."""
+        now = time.time()
+        if now < self.last:
+            now = self.last
+        self.last = now
+        try:
+            self.queue.put_nowait((now, direction, line))
+        except Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def inbound(self, line):
+        self.record(INBOUND, line)
+
+    def outbound(self, line):
+        self.record(OUTBOUND, line)
+
+    ## The writer thread
+
+    def _run(self):
+        capture = None
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=1.0)
+                except Empty:
+                    if capture is not None:
+                        capture.flush()
+                    continue
+                if item is None:
+                    break
+                if capture is None or capture.full():
+                    if capture is not None:
+                        capture.close()
+                    capture = Capture(self._next_path(), self.max_bytes,
+                                      self.max_age)
+                    self._expire()
+                capture.write(*item)
+                if self.dropped:
+                    with self._dropped_lock:
+                        dropped, self.dropped = self.dropped, 0
+                    self.log.warning('Dropped %d lines', dropped)
+        except (IOError, OSError):
+            self.log.exception('Recording stopped')
+        finally:
+            if capture is not None:
+                capture.close()
+
+    def _next_path(self):
+        # Numbered so names sort in order even within the same second.
+        base = os.path.join(self.directory,
+                            time.strftime('capture-%Y%m%d-%H%M%S'))
+        while True:
+            path = '%s-%04d%s' % (base, self.sequence, SUFFIX)
+            self.sequence += 1
+            if not os.path.exists(path):
+                return path
+
+    def _expire(self):
+        for path in captures(self.directory)[:-self.keep]:
+            os.remove(path)
+
+
+class Capture(object):
+    """A single capture file that's being written."""
+
+    def __init__(self, path, max_bytes, max_age):
+        self.file = gzip.open(path, 'wb')
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.expires = time.time() + max_age
+
+    def write(self, timestamp, direction, line):
+        self.file.write(RECORD.pack(timestamp, direction, len(line)))
+        self.file.write(line)
+        self.size += RECORD.size + len(line)
+
+    def full(self):
+        return self.size >= self.max_bytes or time.time() >= self.expires
+
+    def flush(self):
+        # A sync flush, so everything so far can be read back while the
+        # file is still being written.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def captures(directory):
+    """Capture files in directory, oldest first."""
+    return sorted(os.path.join(directory, name)
+                  for name in os.listdir(directory) if name.endswith(SUFFIX))
+
+
+def read_capture(path, chunksize=256 * 1024):
+    """Generate (timestamp, direction, line) for every record in path.
+
+    The file is mapped into memory and decompressed a chunk at a time, so
+    captures of any size can be read without loading them.  A record that
+    was cut off, by a crash or because the file is still being written, ends
+    the iteration.
+
+    """
+    header = RECORD.size
+    unpack = RECORD.unpack_from
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = ''
+            for chunk in _inflate(data, chunksize):
+                buf += chunk
+                pos = 0
+                while pos + header <= len(buf):
+                    timestamp, direction, length = unpack(buf, pos)
+                    start = pos + header
+                    if start + length > len(buf):
+                        break
+                    yield timestamp, direction, buf[start:start + length]
+                    pos = start + length
+                buf = buf[pos:]
+        finally:
+            data.close()
+
+
+def _inflate(data, chunksize):
+    """Decompress the gzip members in data a chunk at a time."""
+    # 16 + MAX_WBITS: expect a gzip header and trailer.
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    offset = 0
+    pending = ''
+    while True:
+        if pending:
+            chunk, pending = pending, ''
+        elif offset < len(data):
+            chunk = data[offset:offset + chunksize]
+            offset += chunksize
+        else:
+            return
+        try:
+            out = inflate.decompress(chunk)
+        except zlib.error:
+            # Garbage at the end of the file, treat it as cut off.
+            return
+        yield out
+        if inflate.unused_data:
+            # Another gzip member follows.
+            pending = inflate.unused_data
+            inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def read_captures(paths):
+    """Like read_capture(), for a series of files one after the other."""
+    for path in paths:
+        for record in read_capture(path):
+            yield record
+
+
+def replay(protocol, records, speed=1.0):
+    """Feed the inbound lines of records to protocol.lineReceived.
+
+    Lines are spaced out like they were recorded, divided by `speed`; a
+    speed of 0 replays everything as fast as possible.  Returns a Deferred
+    that fires with the number of lines once they've all been fed.
+
+    """
+    d = defer.Deferred()
+    inbound = ((timestamp, line) for timestamp, direction, line in records
+               if direction == INBOUND)
+    state = {'count': 0, 'first': None, 'start': None, 'next': None}
+
+    def step():
+        now = time.time()
+        while True:
+            record = state['next']
+            if record is None:
+                record = next(inbound, None)
+                if record is None:
+                    d.callback(state['count'])
+                    return
+                if state['first'] is None:
+                    state['first'] = record[0]
+                    state['start'] = now
+            if speed:
+                due = state['start'] + (record[0] - state['first']) / speed
+                if due > now:
+                    state['next'] = record
+                    reactor.callLater(due - now, step)
+                    return
+            state['next'] = None
+            protocol.lineReceived(record[1])
+            state['count'] += 1
+
+    reactor.callLater(0, step)
+    return d
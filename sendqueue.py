@@ -0,0 +1,155 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Outgoing message scheduling for Shirk.
+
+IRC servers kill clients that send too much too fast, so everything the bot
+sends goes through a SendQueue and is let out by a TokenBucket that mirrors
+the server's flood limits.
+
+"""
+
+import time
+from collections import deque, OrderedDict
+
+# Priority lanes, lower goes first.  Protocol traffic like PONG shouldn't be
+# stuck behind a plug that's spewing output, and neither should plug output
+# be stuck behind a pile of WHOIS requests.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TokenBucket(object):
+    """Allow `burst` lines at once and `rate` lines per second after that."""
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def ready(self, cost=1):
+        """Are there enough tokens for something that costs `cost`?"""
+        self._refill()
+        return self.tokens >= cost
+
+    def consume(self, cost=1):
+        """Take `cost` tokens if there are enough, return whether we did."""
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def delay(self, cost=1):
+        """Number of seconds until `cost` tokens are available."""
+        self._refill()
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class SendQueue(object):
+    """Lines waiting to be sent, by priority and then by target.
+
+    Within a priority lane the targets take turns, so one channel getting a
+    wall of text doesn't hold up replies elsewhere.
+
+    Lines can be pushed with a `ttl`, after which they're dropped instead of
+    sent, and with a `key`: pushing a line with a key that's still queued
+    replaces the queued line in place instead of adding another one.
+
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # One OrderedDict per priority: target -> deque of entries, where an
+        # entry is a list [line, expiry time or None, key or None].
+        self.lanes = [OrderedDict() for prio in (PRIORITY_HIGH,
+                                                 PRIORITY_NORMAL,
+                                                 PRIORITY_LOW)]
+        self.keyed = dict()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def push(self, line, priority=PRIORITY_NORMAL, target=None, key=None,
+             ttl=None):
+        expires = None if ttl is None else self.clock() + ttl
+        if key is not None and key in self.keyed:
+            entry = self.keyed[key]
+            entry[0] = line
+            entry[1] = expires
+            return
+        entry = [line, expires, key]
+        lane = self.lanes[priority]
+        if target not in lane:
+            lane[target] = deque()
+        lane[target].append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.length += 1
+
+    def pop(self):
+        """Return the next line that should be sent, or None."""
+        now = None
+        for lane in self.lanes:
+            while lane:
+                target, entries = lane.popitem(last=False)
+                entry = entries.popleft()
+                if entries:
+                    # Back of the line for this target.
+                    lane[target] = entries
+                self.length -= 1
+                if entry[2] is not None:
+                    del self.keyed[entry[2]]
+                if entry[1] is not None:
+                    if now is None:
+                        now = self.clock()
+                    if entry[1] < now:
+                        continue
+                return entry[0]
+        return None
+
+    def drop(self, target):
+        """Forget everything that's queued for target."""
+        for lane in self.lanes:
+            entries = lane.pop(target, ())
+            for entry in entries:
+                if entry[2] is not None:
+                    del self.keyed[entry[2]]
+            self.length -= len(entries)
+
+
+def split_utf8(text, length):
+    """Split the bytestring text into chunks of at most `length` bytes.
+
+    Splits on the last space that fits if there is one, and otherwise makes
+    sure not to cut a UTF-8 sequence in half.  An empty string gives no
+    chunks at all, servers don't take empty messages.
+
+    """
+    chunks = []
+    while len(text) > length:
+        cut = text.rfind(' ', 0, length + 1)
+        if cut > 0:
+            chunks.append(text[:cut])
+            text = text[cut + 1:]
+        else:
+            cut = length
+            # Continuation bytes look like 10xxxxxx.
+            while cut > 0 and ord(text[cut]) & 0xC0 == 0x80:
+                cut -= 1
+            if cut == 0:
+                cut = length
+            chunks.append(text[:cut])
+            text = text[cut:]
+    if text:
+        chunks.append(text)
+    return chunks
@@ -9,15 +9,131 @@
 import importlib
 import json
 import logging
+import logging.handlers
+import os
 import sys
+import time
 
 # Twisted imports
 from twisted.words.protocols import irc
 from twisted.internet import reactor, protocol
+from twisted.python import threadable
+from twisted.python.threadpool import ThreadPool
 
 # Project imports
+from plugs import plugbase
 from util import Event
+import commands
+import confstore
+import ircmsg
+import logqueue
+import matching
+import profiling
+import recorder
+import sendqueue
+import store
+import timers
 import users
+import workers
+
+# Default configuration, conf.json is applied on top of this.
+DEFAULT_CONFIG = {
+    # The nickname to use
+    'nickname': 'shirk',
+    # Password to send while connecting.  Many servers pass this on to
+    # Nickserv.
+    'password': '',
+    # The bot's "real" name
+    'realname': 'Fedmahn',
+    # Username, generally useless unless there's an identd server running.
+    'username': 'shirk',
+    # Debug level: 0 -> warnings, 1 -> info, 2 -> full debug
+    'debug': 0,
+    # Channels to join at first
+    'channels': [],
+    'server': 'chat.freenode.net',
+    'port': 6667,
+    # The plugs to load at startup.
+    'plugs': ['Core', 'Auth'],
+    # The prefix for !commands (or +commands, or @commands, or..)
+    'cmd_prefix': '!',
+    # Whether commands can be abbreviated to any unique prefix, like !pi
+    # for !ping.  Off by default, it makes !q quit.
+    'cmd_abbreviations': False,
+    # Incoming command flood control: every user and every channel can run
+    # cmd_*_burst commands at once and cmd_*_rate per second after that,
+    # with commands that declare a higher cost counting for more.  A rate
+    # of 0 turns that limit off.  Users with at least cmd_exempt_power
+    # aren't limited.
+    'cmd_user_rate': 0.5,
+    'cmd_user_burst': 5,
+    'cmd_channel_rate': 1.0,
+    'cmd_channel_burst': 10,
+    'cmd_exempt_power': 10,
+    # Initial delay between reconnections when there's a connection
+    # failure.
+    'reconn_delay': 1,
+    # Maximum reconnection retries
+    'reconn_tries': 8,
+    # charset used to decode messages
+    'charset': 'utf-8',
+    # Outgoing flood control: the bot can send flood_burst lines at once
+    # and flood_rate lines per second after that.
+    'flood_burst': 5,
+    'flood_rate': 1.0,
+    # Seconds to wait for users who quit in a netsplit to come back
+    # before they're forgotten.
+    'netsplit_grace': 300,
+    # Where the user table is saved on shutdown, so a restart doesn't
+    # have to find out everything about everyone all over again.
+    'snapshot_file': 'snapshot.json',
+    # Snapshots older than this many seconds are ignored.
+    'snapshot_max_age': 300,
+    # Size of the thread pool for plug handlers that are marked threaded.
+    'threads': 4,
+    # Where !profile writes its results.
+    'profile_dir': '.',
+    # Directory to record all IRC traffic to, see recorder.py.  None turns
+    # recording off.
+    'record_dir': None,
+    # Start a new capture file after this many bytes or seconds, and keep
+    # this many files.
+    'record_max_bytes': 64 * 1024 * 1024,
+    'record_max_age': 3600,
+    'record_keep': 24,
+    # Networks to connect to.  Each entry is a dictionary of settings that
+    # override the ones above for that network, such as server, port,
+    # nickname, channels and plugs, plus an optional name for the logs.  An
+    # empty list means just the one network configured above.
+    'networks': [],
+    # Plugs that are loaded once and shared by all networks instead of once
+    # per network.  Only suitable for plugs that keep no per-network state
+    # of their own, see Networks.
+    'shared_plugs': [],
+    # Plugs that run in a process of their own, see workers.py.
+    'worker_plugs': [],
+    # The database for Plug.store, see store.py.  Writes are passed to the
+    # database every store_flush_interval seconds.
+    'store_file': 'shirk.db',
+    'store_flush_interval': 5,
+    # Seconds between checks whether a file in plugconf/ changed, see
+    # confstore.py.  0 turns it off, changes then need a reload.
+    'plugconf_interval': 5,
+    # The log file, which is written from a thread of its own and rotated
+    # after log_max_bytes, keeping log_backups old ones.  With log_json
+    # every line is a JSON object instead of plain text.
+    'log_file': 'shirk.log',
+    'log_max_bytes': 10 * 1024 * 1024,
+    'log_backups': 5,
+    'log_json': False
+}
+
+
+def _same_code(a, b):
+    """Do two code objects do the same, wherever they are in the file?"""
+    return (a.co_code, a.co_consts, a.co_names, a.co_varnames) == \
+        (b.co_code, b.co_consts, b.co_names, b.co_varnames)
+
 
 class Shirk(irc.IRCClient):
     """A simple modular IRC bot.
@@ -38,34 +154,236 @@ class Shirk(irc.IRCClient):
     # List of events that don't need any other information in the hook,
     # unlike .command and .raw which need other params specified.
     _simple_events = [Event.addressed, Event.chanmsg, Event.private,
-        Event.userjoined, Event.usercreated, Event.userremoved, Event.userrenamed]
+        Event.userjoined, Event.usersjoined, Event.usercreated,
+        Event.userscreated, Event.userremoved, Event.userrenamed]
+    # Batched events and the per-user events they stand in for.  Plugs that
+    # hook the per-user event but not the batched one get one call per user.
+    _batch_events = {Event.usersjoined: Event.userjoined,
+                     Event.userscreated: Event.usercreated}
+    # Outgoing commands that don't go in the normal priority lane.
+    _send_priorities = {'PONG': sendqueue.PRIORITY_HIGH,
+                        'PING': sendqueue.PRIORITY_HIGH,
+                        'PASS': sendqueue.PRIORITY_HIGH,
+                        'NICK': sendqueue.PRIORITY_HIGH,
+                        'USER': sendqueue.PRIORITY_HIGH,
+                        'QUIT': sendqueue.PRIORITY_HIGH,
+                        'WHO': sendqueue.PRIORITY_LOW,
+                        'WHOIS': sendqueue.PRIORITY_LOW}
+    # plugname -> {source file: mtime} as of the last time the plug's modules
+    # were (re)loaded.  Shared by all instances, just like sys.modules.
+    _plug_mtimes = {}
 
     def load_plugs(self):
         """Load the plugs listed in config."""
         self.plugs = {}
         self.hooks = {Event.raw:        {},  # dictionary of
-                      Event.command:    {}}  # 'command': set([plug, plug])
+                      Event.command:    {},  # 'command': [plug, plug]
+                      Event.match:      {}}
+        # The dispatch tables mirror self.hooks, but as tuples that are only
+        # replaced (never mutated) when a plug is added or removed.  That way
+        # the event_* methods can iterate them without copying, even when a
+        # handler ends up loading or unloading plugs.
+        self.dispatch = {Event.raw:     {},
+                         Event.command: {},
+                         Event.match:   {}}
+        # Batched event -> plugs that only want the per-user version.
+        self.unbatched = {}
         for ev in self._simple_events:
-            self.hooks[ev] = set()
+            self.hooks[ev] = []
+            self.dispatch[ev] = ()
+        for ev in self._batch_events:
+            self.unbatched[ev] = ()
+        self.router = commands.Router(self.dispatch[Event.command],
+                                      self.config['cmd_abbreviations'])
+        self.matcher = matching.Matcher(self.dispatch[Event.match],
+                                        self.users)
+        # Goes up whenever a plug is loaded, reloaded or unloaded or changes
+        # its hooks, so anything derived from the plugs and their hooks
+        # (like plugbase.cached responses) knows it's out of date.
+        self.generation = 0
+        # plugname -> (seconds spent importing, seconds spent in __init__)
+        self.plug_timings = {}
         for plugname in self.config['plugs']:
+            manifest = self._read_manifest(plugname)
+            if manifest.get('lazy') and \
+                    plugname not in self.config['worker_plugs']:
+                plug = plugbase.LazyPlug(self, plugname, manifest)
+                self.plugs[plugname] = plug
+                plug.hook_events()
+                continue
             try:
                 self.load_plug(plugname)
             except ImportError:
                 self.log.exception('Failed to load plug %s.', plugname)
 
+    def _read_manifest(self, plugname):
+        """Read plugs/<plugname>/manifest.json, see plugbase.LazyPlug."""
+        path = os.path.join(os.path.dirname(plugbase.__file__), plugname,
+                            'manifest.json')
+        try:
+            return json.load(open(path))
+        except IOError:
+            return {}
+        except ValueError:
+            self.log.exception('Broken manifest for plug %s.', plugname)
+            return {}
+
+    def startup_report(self):
+        """Log how long connecting and loading the plugs took."""
+        timings = ', '.join('%s (import %.1fms, load %.1fms)'
+            % (plugname, imported * 1000, loaded * 1000)
+            for plugname, (imported, loaded)
+            in sorted(self.plug_timings.iteritems()))
+        lazy = ', '.join(sorted(name for name, plug in self.plugs.iteritems()
+                                if isinstance(plug, plugbase.LazyPlug)))
+        self.log.info('Ready %.1fs after connecting.  Plugs: %s.  Lazy: %s.',
+            time.time() - self.connected_at, timings or 'none', lazy or 'none')
+
     def load_plug(self, plugname):
         """Load the plug identified by plugname.
 
-        Loads and reloads the module to make sure we get any updated code,
-        instantiates the plug and tells it to request event hooks.
-        Raises ImportError if the module can't be found.
+        Imports the module, reloading it if any of its files changed since
+        it was last loaded, instantiates the plug and tells it to request
+        event hooks.  If the plug was already loaded, the old instance is
+        only removed once the new one is ready to take over.
+        Returns the new plug.  Raises ImportError if the module can't be
+        found.
+
+        Plugs in config['worker_plugs'] are run in a worker process by a
+        workers.WorkerPlug instead.
 
         """
-        module = importlib.import_module('plugs.' + plugname)
-        reload(module)
+        if plugname in self.config['worker_plugs']:
+            plug = workers.WorkerPlug(self, plugname, self.startingup)
+            if plugname in self.plugs:
+                self.remove_plug(plugname)
+            self.plugs[plugname] = plug
+            plug.hook_events()
+            return plug
+        shared = plugname in self.config['shared_plugs']
+        if shared:
+            plug = self.networks.shared_plug(plugname)
+            if plug is not None and self not in self.networks.users_of(
+                    plugname):
+                # Another network loaded it already.
+                self.networks.share(plugname, plug, self)
+                self.install_plug(plugname, plug)
+                return plug
+        start = time.time()
+        module = self._import_plug(plugname)
+        imported = time.time()
         plug = module.Plug(self, self.startingup)
+        self.plug_timings[plugname] = (imported - start,
+                                       time.time() - imported)
+        if shared:
+            plug.shared = True
+            old = self.plugs.get(plugname)
+            for core in self.networks.share(plugname, plug, self):
+                core.install_plug(plugname, plug)
+            if old is not None:
+                old.cleanup()
+            return plug
+        if plugname in self.plugs:
+            self.remove_plug(plugname)
         self.plugs[plugname] = plug
         plug.hook_events()
+        self.confstore.watch(plugname, self, plug)
+        return plug
+
+    def install_plug(self, plugname, plug):
+        """Hook up a shared plug, replacing whatever was loaded as plugname.
+
+        The previous instance is unhooked but not cleaned up, that's up to
+        whoever is replacing it.
+
+        """
+        if plugname in self.plugs:
+            self._unhook_plug(plugname)
+        self.plugs[plugname] = plug
+        with plugbase.current_core(self):
+            plug.hook_events()
+        self.confstore.watch(plugname, self, plug)
+
+    def reload_plug(self, plugname):
+        """Reload a loaded plug's code without replacing the instance.
+
+        Only does anything if the plug's source files changed.  The plug
+        keeps its state and just gets the new class, and only the hooks for
+        triggers that came or went are updated (see Plug.rehook_events).
+        Plug.load isn't run again, the plug's reloaded() is called instead,
+        so anything new versions set up in load() wouldn't be there.  That's
+        why a plug whose load() changed is loaded from scratch, as is one
+        whose new class can't take over the instance.  Returns False if there
+        was nothing to reload.  Raises KeyError if the plug isn't loaded.
+
+        """
+        plug = self.plugs[plugname]
+        if isinstance(plug, workers.WorkerPlug):
+            # The worker imports the latest code when it starts.
+            plug.restart()
+            return True
+        if isinstance(plug, plugbase.LazyPlug) or \
+                not self._plug_changed(plugname):
+            # Lazy plugs get the latest code whenever they do get loaded.
+            return False
+        old_load = plug.__class__.load.im_func.func_code
+        module = self._import_plug(plugname)
+        if not _same_code(old_load, module.Plug.load.im_func.func_code):
+            self.log.info('Plug %s has a new load(), loading it from '
+                'scratch.', plugname)
+            self.load_plug(plugname)
+            return True
+        try:
+            plug.__class__ = module.Plug
+        except TypeError:
+            self.log.info('Plug %s changed too much, loading it from scratch.',
+                plugname)
+            self.load_plug(plugname)
+        else:
+            if plug.shared:
+                for core in self.networks.users_of(plugname):
+                    core.install_plug(plugname, plug)
+            else:
+                plug.rehook_events()
+            self.generation += 1
+            with plugbase.current_core(self):
+                plug.reloaded()
+            self.log.info('Reloaded plug %s.', plugname)
+        return True
+
+    def _import_plug(self, plugname):
+        """Import a plug's module, reloading it if its files changed."""
+        modname = 'plugs.' + plugname
+        if modname in sys.modules:
+            module = sys.modules[modname]
+            if self._plug_changed(plugname):
+                reload(module)
+        else:
+            module = importlib.import_module(modname)
+        self._plug_mtimes[plugname] = self._plug_files(plugname)
+        return module
+
+    def _plug_changed(self, plugname):
+        """Have any of the plug's source files changed since it was loaded?"""
+        return self._plug_files(plugname) != self._plug_mtimes.get(plugname)
+
+    def _plug_files(self, plugname):
+        """Return {source file: mtime} for the plug's loaded modules."""
+        modname = 'plugs.' + plugname
+        files = {}
+        for name, module in sys.modules.items():
+            if module is not None and (name == modname or
+                                       name.startswith(modname + '.')):
+                path = getattr(module, '__file__', None)
+                if path is None:
+                    continue
+                if path.endswith(('.pyc', '.pyo')):
+                    path = path[:-1]
+                try:
+                    files[path] = os.path.getmtime(path)
+                except OSError:
+                    pass
+        return files
 
     def remove_plug(self, plugname):
         """Remove the plug identified by plugname.
@@ -75,13 +393,28 @@ class Shirk(irc.IRCClient):
 
         """
         plug = self.plugs[plugname]
-        plug.cleanup()
-        for cmd, callbacks in self.hooks[Event.command].iteritems():
-            callbacks.discard(plug)
-        for cmd, callbacks in self.hooks[Event.raw].iteritems():
-            callbacks.discard(plug)
+        if self.networks.release(plugname, plug, self):
+            plug.cleanup()
+        self._unhook_plug(plugname)
+
+    def _unhook_plug(self, plugname):
+        """Remove the plug's hooks and forget about it, without cleanup."""
+        plug = self.plugs[plugname]
+        for event in (Event.command, Event.raw, Event.match):
+            for cmd, callbacks in self.hooks[event].iteritems():
+                if plug in callbacks:
+                    callbacks.remove(plug)
+                    self.dispatch[event][cmd] = tuple(callbacks)
+                    if event == Event.command and not callbacks:
+                        self.router.remove(cmd)
+        self.router.invalidate()
+        self.matcher.invalidate()
+        self.generation += 1
         for ev in self._simple_events:
-            self.hooks[ev].discard(plug)
+            if plug in self.hooks[ev]:
+                self.hooks[ev].remove(plug)
+                self._update_dispatch(ev)
+        self.confstore.unwatch(plugname, self)
         del self.plugs[plugname]
 
     def shutdown(self, msg, restart=False):
@@ -100,19 +433,189 @@ class Shirk(irc.IRCClient):
             self.log.info('Shutdown: ' + msg)
         self.factory.shuttingdown = True
         self.factory.restart = restart
-        for name, plug in self.plugs.iteritems():
-            plug.cleanup()
+        try:
+            self.users.save_snapshot(self.config['snapshot_file'])
+        except (IOError, OSError):
+            self.log.exception('Failed to save the user snapshot')
+        self.cleanup_plugs()
         self.quit(msg)
+        if restart:
+            # Restarting means restarting the process, so the other networks
+            # have to go as well.
+            self.networks.shutdown(msg, exclude=self.factory)
+
+    def cleanup_plugs(self):
+        """Tell the plugs to clean up, except shared plugs still in use."""
+        for name, plug in self.plugs.iteritems():
+            if self.networks.release(name, plug, self):
+                plug.cleanup()
+
+    def start_profiling(self, seconds, done):
+        """Profile line handling and event dispatch for a while.
+
+        lineReceived and the event_* methods are swapped for profiled
+        versions on this instance, so there's no overhead when nobody's
+        looking.  After `seconds` the originals are put back, the results are
+        written to profile_dir and done(summary) is called with a few lines
+        of summary.  Returns False if a profile is already running.
+
+        """
+        if self.profiler is not None:
+            return False
+        self.profiler = profiling.DispatchProfiler()
+        for name in self._profiled_methods():
+            setattr(self, name, self.profiler.wrap(getattr(self, name)))
+        self._profile_call = self.callLater(seconds, self.stop_profiling,
+                                            done)
+        self.log.info('Profiling for %ss', seconds)
+        return True
+
+    def stop_profiling(self, done=None):
+        """Stop profiling and write out the results, if we were profiling."""
+        if self.profiler is None:
+            return
+        if self._profile_call.active():
+            self._profile_call.cancel()
+        self._profile_call = None
+        for name in self._profiled_methods():
+            # Remove the instance attribute so the method shows through.
+            delattr(self, name)
+        profiler, self.profiler = self.profiler, None
+        path = os.path.join(self.config['profile_dir'],
+                            time.strftime('profile-%Y%m%d-%H%M%S'))
+        try:
+            summary = profiler.report(path)
+        except (IOError, OSError):
+            self.log.exception('Failed to write the profile')
+            summary = ['Failed to write the profile to %s' % (path,)]
+        else:
+            self.log.info('Profile written to %s', path)
+        if done is not None:
+            done(summary)
+
+    def _profiled_methods(self):
+        return ['lineReceived'] + [name for name in dir(self.__class__)
+                                   if name.startswith('event_')]
 
-    def sendLine(self, line):
-        """Sends a line to the other end of the connection.
+    def sendLine(self, line, priority=None, target=None, key=None, ttl=None):
+        """Queues a line to be sent to the other end of the connection.
 
         Overridden to make sure everything's encoded right, something
-        upstream doesn't like unicode strings.
+        upstream doesn't like unicode strings, and to send everything through
+        the send queue.
+
+        priority: One of the sendqueue.PRIORITY_* lanes.  By default this is
+            worked out from the command, see _send_priorities.
+        target: Lines for the same target share a slot in the round-robin.
+            Defaults to the first parameter of the command.
+        key, ttl: See sendqueue.SendQueue.
+
+        Safe to call from threaded handlers, the line is passed back to the
+        reactor thread.
+
+        """
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.sendLine, line, priority, target,
+                                   key, ttl)
+            return
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        if priority is None or target is None:
+            parts = line.split(' ', 2)
+            if priority is None:
+                priority = self._send_priorities.get(parts[0].upper(),
+                    sendqueue.PRIORITY_NORMAL)
+            if target is None and len(parts) > 1:
+                target = parts[1]
+        if target is not None:
+            # So drop() gets #Chan's lines as well as #chan's.
+            target = self.users.fold(target)
+        self.sendqueue.push(line, priority, target, key, ttl)
+        if self._send_call is None:
+            # Otherwise the pending call sends it when there are tokens.
+            self._flush_sendqueue()
+
+    @property
+    def threadpool(self):
+        """The thread pool for threaded plug handlers, see plugbase."""
+        return self.networks.get_threadpool()
+
+    @property
+    def networks(self):
+        return self.factory.networks
+
+    @property
+    def confstore(self):
+        return self.networks.confstore
+
+    def open_store(self, plugname):
+        """Return the store.PlugStore for plugname, see Plug.store."""
+        return self.networks.get_database(self.config['store_file'],
+            self.config['store_flush_interval']).store(plugname)
+
+    def reconfigure_plug(self, plug, changed):
+        """Pass a change in plug's config file on, see ConfigStore."""
+        with plugbase.current_core(self):
+            plug.reconfigure(changed)
+
+    def callLater(self, delay, f, *args, **kw):
+        """reactor.callLater, with this connection as the current core.
+
+        For timers that end up calling plugs, so shared plugs know which
+        network they're dealing with.
 
         """
-        line = line.encode('utf-8')
-        irc.IRCClient.sendLine(self, line)
+        return reactor.callLater(delay, self._call_with_core, f, args, kw)
+
+    def _call_with_core(self, f, args, kw):
+        with plugbase.current_core(self):
+            return f(*args, **kw)
+
+    def _flush_sendqueue(self):
+        """Send whatever the token bucket allows, then wait for more tokens."""
+        while self.sendqueue and self.send_bucket.ready():
+            line = self.sendqueue.pop()
+            if line is None:
+                break
+            self.send_bucket.consume()
+            irc.IRCClient.sendLine(self, line)
+            if self.recorder is not None:
+                self.recorder.outbound(line)
+        if self.sendqueue and self._send_call is None:
+            self._send_call = reactor.callLater(self.send_bucket.delay(),
+                                                self._send_timer_fired)
+
+    def _send_timer_fired(self):
+        self._send_call = None
+        self._flush_sendqueue()
+
+    def msg(self, user, message, length=None, key=None, ttl=None):
+        """Send a message to a user or channel.
+
+        Like IRCClient.msg, but the splitting of long lines counts bytes
+        rather than characters so multibyte UTF-8 doesn't push lines over
+        the server's limit.  key and ttl are passed on to the send queue,
+        see sendqueue.SendQueue.
+
+        """
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        fmt = 'PRIVMSG %s :' % (user,)
+        if length is None:
+            length = self._safeMaximumLineLength(fmt)
+        # Account for the line terminator.
+        minimumLength = len(fmt) + 2
+        if length <= minimumLength:
+            raise ValueError("Maximum length must exceed %d for message "
+                             "to %s" % (minimumLength, user))
+        lines = []
+        for line in message.split('\n'):
+            lines.extend(sendqueue.split_utf8(line, length - minimumLength))
+        for i, line in enumerate(lines):
+            self.sendLine(fmt + line, target=user,
+                key=None if key is None else (key, i), ttl=ttl)
 
     ## Twisted's callbacks
     # Things the bot does
@@ -125,15 +628,39 @@ class Shirk(irc.IRCClient):
         """
         self.log = self.factory.log
         self.log.info('Connected to server')
+        self.connected_at = time.time()
         # Connected successfully, so reset the reconn delay
         self.factory.resetDelay()
         self.users = users.Users(self)
+        self.users.load_snapshot(self.config['snapshot_file'],
+                                 self.config['snapshot_max_age'])
+        self.flood_guard = commands.FloodGuard(self.users,
+            self.config['cmd_user_rate'], self.config['cmd_user_burst'],
+            self.config['cmd_channel_rate'], self.config['cmd_channel_burst'],
+            self.config['cmd_exempt_power'])
+        # For Plug.call_later and call_every.
+        self.timers = timers.TimingWheel(self._call_with_core,
+                                         self.log.getChild('timers'))
         self.nickname = self.config['nickname']
         self.password = self.config['password']
         self.cmd_prefix = self.config['cmd_prefix']
         self.realname = self.config['realname']
         self.username = self.config['username']
         self.startingup = True
+        self.sendqueue = sendqueue.SendQueue()
+        self.send_bucket = sendqueue.TokenBucket(self.config['flood_rate'],
+                                                 self.config['flood_burst'])
+        self._send_call = None
+        # command -> symbolic name of its irc_* handler, or None if there's
+        # no handler.  Filled in by lineReceived as commands come in.
+        self._irc_handlers = {}
+        # channel -> [(nickname, username, hostmask)] of WHO replies that are
+        # waiting for RPL_ENDOFWHO.
+        self._who_replies = {}
+        self.profiler = None
+        self._profile_call = None
+        self.recorder = self.factory.get_recorder()
+        self.factory.bot = self
         self.startHeartbeat()
         irc.IRCClient.connectionMade(self)
 
@@ -147,13 +674,21 @@ class Shirk(irc.IRCClient):
         whether it was a clean disconnect.
 
         """
-        self.log.info('Connection lost: %s' % (reason,))
+        self.log.info('Connection lost: %s', reason)
         self.stopHeartbeat()
+        self.stop_profiling()
+        if self.factory.bot is self:
+            self.factory.bot = None
+        if self._send_call is not None:
+            self._send_call.cancel()
+            self._send_call = None
+        # Whatever shared plugs still had going on this network.
+        self.timers.stop()
         try:
             if not self.factory.shuttingdown:
                 # When shutting down on purpose everything is unloaded *before* disconnecting.
-                for name, plug in self.plugs.iteritems():
-                    plug.cleanup()
+                self.cleanup_plugs()
+            self.users.cleanup()
             del self.users
         except AttributeError:
             # this happens when the bot is shutdown before having connected
@@ -167,13 +702,29 @@ class Shirk(irc.IRCClient):
         self.load_plugs()
         for chan in self.config['channels']:
             self.join(chan)
-        self.lineRate = 0.3
         self.startingup = False
+        self.startup_report()
+
+    def isupport(self, options):
+        """Called with the features the server supports (RPL_ISUPPORT)."""
+        for option in options:
+            if option.startswith('CASEMAPPING='):
+                self.users.set_casemapping(option.split('=', 1)[1])
 
     def joined(self, channel):
         """Called when I finish joining a channel."""
         self.sendLine('WHO %s' % (channel,))
 
+    def left(self, channel):
+        """Called when I have left a channel."""
+        self.users.drop_channel(channel)
+        self.sendqueue.drop(self.users.fold(channel))
+
+    def kickedFrom(self, channel, kicker, message):
+        """Called when I have been kicked from a channel."""
+        self.users.drop_channel(channel)
+        self.sendqueue.drop(self.users.fold(channel))
+
     # Things other users do
 
     def userJoined(self, user, channel):
@@ -189,7 +740,10 @@ class Shirk(irc.IRCClient):
         self.users.user_left(kickee, channel)
 
     def userQuit(self, user, quitMessage):
-        self.users.user_quit(user)
+        if users.is_netsplit(quitMessage):
+            self.users.user_split(user)
+        else:
+            self.users.user_quit(user)
 
     def userRenamed(self, oldname, newname):
         self.users.user_nickchange(oldname, newname)
@@ -198,30 +752,50 @@ class Shirk(irc.IRCClient):
         """The bot receives a PRIVMSG, either in channel or in PM"""
         user = user.split('!', 1)[0]
         msg = msg.strip()
-        self.log.debug('%s: <%s> %s' % (target, user, msg))
+        self.log.debug('%s: <%s> %s', target, user, msg)
         # Check to see if they're sending me a private message
         if target == self.nickname:
             self.event_private(user, msg, False)
         else:
             self.event_chanmsg(user, target, msg, False)
+            self.event_match(user, target, msg, False)
         if msg.startswith(self.cmd_prefix) and len(msg) > 1:
-            argv = msg[len(self.cmd_prefix):].split()
-            self.event_command(user, target, argv)
+            self.route_command(user, target, msg[len(self.cmd_prefix):])
         elif msg.startswith(self.nickname):
             # +1 to account for : or , or whatever
             message = msg[len(self.nickname) + 1:].strip()
             self.event_addressed(user, target, message)
 
+    def route_command(self, source, target, line):
+        """Pass a !command on to event_command if it's allowed to run.
+
+        line is the message without the command prefix.  Commands nobody
+        handles and commands over the flood limits (see
+        commands.FloodGuard) are dropped before the line is even split.
+
+        """
+        end = line.find(' ')
+        cmd = self.router.resolve(line if end == -1 else line[:end])
+        if cmd is None:
+            return
+        channel = None if target == self.nickname else target
+        if not self.flood_guard.allow(source, channel,
+                                      self.router.costs.get(cmd, 1)):
+            return
+        rest = '' if end == -1 else line[end + 1:]
+        self.event_command(source, target, commands.Argv(cmd, rest))
+
     def action(self, user, target, msg):
         """The bot sees someone perform a CTCP ACTION, or "/me"."""
         user = user.split('!', 1)[0]
         msg = msg.strip()
-        self.log.debug('%s: * %s %s' % (target, user, msg))
+        self.log.debug('%s: * %s %s', target, user, msg)
         # Check to see if they're sending me a private message
         if target == self.nickname:
             self.event_private(user, msg, True)
         else:
             self.event_chanmsg(user, target, msg, True)
+            self.event_match(user, target, msg, True)
 
     # Lower-level callbacks
 
@@ -235,26 +809,63 @@ class Shirk(irc.IRCClient):
             self.userJoined(prefix, channel)
 
     def irc_RPL_WHOREPLY(self, prefix, params):
-        """Received a reply to a vanilla WHO command"""
-        self.users.user_joined(params[5],  # nickname
-                               params[2],  # username
-                               params[3],  # hostmask
-                               params[1])  # channel
-        self.event_userjoined(params[5], params[1])
+        """Received a reply to a vanilla WHO command.
+
+        Replies are collected per channel and only applied once the server
+        sends RPL_ENDOFWHO.
+
+        """
+        self._who_replies.setdefault(params[1], []).append(
+            (params[5],   # nickname
+             params[2],   # username
+             params[3]))  # hostmask
+
+    def irc_RPL_ENDOFWHO(self, prefix, params):
+        """The server is done sending WHO replies.
+
+        The server answers one WHO at a time, so anything that's still
+        buffered belongs to this reply.
+
+        """
+        who_replies, self._who_replies = self._who_replies, {}
+        for channel, who in who_replies.iteritems():
+            nicknames = self.users.users_joined(channel, who)
+            self.event_usersjoined(nicknames, channel)
+
+    def dataReceived(self, data):
+        """Handle incoming data with this connection as the current core."""
+        with plugbase.current_core(self):
+            irc.IRCClient.dataReceived(self, data)
 
     def lineReceived(self, line):
-        line = irc.lowDequote(line).decode(self.config['charset'], 'replace')
+        """Parse a line from the server and hand it to whoever wants it.
+
+        Only the command is looked at up front.  Lines without an irc_*
+        handler or raw hooks are dropped before anything gets decoded
+        (IRCClient.irc_unknown doesn't do anything with them either), the rest
+        is decoded lazily by ircmsg.Message.
+
+        """
+        if self.recorder is not None:
+            self.recorder.inbound(line)
         try:
-            prefix, command, params = irc.parsemsg(line)
-            if command in irc.numeric_to_symbolic:
-                parsedcmd = irc.numeric_to_symbolic[command]
-            else:
-                parsedcmd = command
-            self.handleCommand(parsedcmd, prefix, params)
-            if self._registered:
-                self.event_raw(command, prefix, params)
+            msg = ircmsg.Message(line, self.config['charset'])
         except irc.IRCBadMessage:
-            self.badMessage(line, *sys.exc_info())
+            self.badMessage(line.decode(self.config['charset'], 'replace'),
+                            *sys.exc_info())
+            return
+        command = msg.command
+        try:
+            parsedcmd = self._irc_handlers[command]
+        except KeyError:
+            parsedcmd = irc.numeric_to_symbolic.get(command, command)
+            if getattr(self, 'irc_' + parsedcmd, None) is None:
+                parsedcmd = None
+            self._irc_handlers[command] = parsedcmd
+        if parsedcmd is not None:
+            self.handleCommand(parsedcmd, msg.prefix, msg.params)
+        if self._registered and command in self.dispatch[Event.raw]:
+            self.event_raw(command, msg.prefix, msg.params)
 
     ## Shirk's events that modules can register callbacks for
 
@@ -267,7 +878,7 @@ class Shirk(irc.IRCClient):
         msg: The actual message.
 
         """
-        for plug in self.hooks[Event.addressed]:
+        for plug in self.dispatch[Event.addressed]:
             plug.handle_addressed(source, target, msg)
 
     def event_chanmsg(self, source, channel, msg, action):
@@ -279,24 +890,33 @@ class Shirk(irc.IRCClient):
         action: A bool indicating whether this was a CTCP ACTION ('/me')
 
         """
-        for plug in self.hooks[Event.chanmsg]:
+        for plug in self.dispatch[Event.chanmsg]:
             plug.handle_chanmsg(source, channel, msg, action)
 
+    def event_match(self, source, channel, msg, action):
+        """Call the plugs whose plugbase.match patterns match a message.
+
+        Takes the same arguments as event_chanmsg.  The message is scanned
+        once for all patterns, see matching.Matcher.
+
+        """
+        for plugs, key, match in self.matcher.scan(channel, msg):
+            for plug in plugs:
+                plug.handle_match(source, channel, msg, action, key, match)
+
     def event_command(self, source, target, argv):
         """The bot receives a !command.
 
         source: The nickname of whoever sent it.
         target: The channel.
-        argv: A list of the command and any arguments.
+        argv: A commands.Argv, the list of the command and any arguments.
+            The command is always the full name, even if it was called by
+            an alias or abbreviation.
 
         """
-        if argv[0] in self.hooks[Event.command]:
-            # copying, otherwise any command that modifies the plug collection
-            # raises an error "Set changed size during iteration"
-            to_call = set(self.hooks[Event.command][argv[0]])
-            for plug in to_call:
-                self.log.debug("Calling %s for command %s" % (plug, argv[0]))
-                plug.handle_command(source, target, argv)
+        for plug in self.dispatch[Event.command].get(argv[0], ()):
+            self.log.debug("Calling %s for command %s", plug, argv[0])
+            plug.handle_command(source, target, argv)
 
     def event_private(self, source, msg, action):
         """The bot is sent a message in PM.
@@ -306,7 +926,7 @@ class Shirk(irc.IRCClient):
         action: A bool indicating whether this was a CTCP ACTION ('/me')
 
         """
-        for plug in self.hooks[Event.private]:
+        for plug in self.dispatch[Event.private]:
             plug.handle_private(source, msg, action)
 
     def event_raw(self, command, prefix, params):
@@ -320,10 +940,8 @@ class Shirk(irc.IRCClient):
         params: ['shirks', 'barometz', 'nazgjunk', 'is logged in as']
 
         """
-        if command in self.hooks[Event.raw]:
-            to_call = set(self.hooks[Event.raw][command])
-            for plug in to_call:
-                plug.handle_raw(command, prefix, params)
+        for plug in self.dispatch[Event.raw].get(command, ()):
+            plug.handle_raw(command, prefix, params)
 
     def event_userjoined(self, nickname, channel):
         """A user has joined a channel, or the bot joined a channel.
@@ -332,9 +950,22 @@ class Shirk(irc.IRCClient):
         channel that the bot just joined.
 
         """
-        for plug in self.hooks[Event.userjoined]:
+        for plug in self.dispatch[Event.userjoined]:
             plug.handle_userjoined(nickname, channel)
 
+    def event_usersjoined(self, nicknames, channel):
+        """A batch of users has been seen in a channel, usually after WHO.
+
+        Plugs that don't handle usersjoined but do handle userjoined get
+        that event for every user in the batch instead.
+
+        """
+        for plug in self.dispatch[Event.usersjoined]:
+            plug.handle_usersjoined(nicknames, channel)
+        for plug in self.unbatched[Event.usersjoined]:
+            for nickname in nicknames:
+                plug.handle_userjoined(nickname, channel)
+
     def event_usercreated(self, user):
         """A new user has been introduced to user management.
 
@@ -342,9 +973,22 @@ class Shirk(irc.IRCClient):
         User instance.
 
         """
-        for plug in self.hooks[Event.usercreated]:
+        for plug in self.dispatch[Event.usercreated]:
             plug.handle_usercreated(user)
 
+    def event_userscreated(self, users):
+        """A batch of new users has been introduced to user management.
+
+        Plugs that don't handle userscreated but do handle usercreated get
+        that event for every user in the batch instead.
+
+        """
+        for plug in self.dispatch[Event.userscreated]:
+            plug.handle_userscreated(users)
+        for plug in self.unbatched[Event.userscreated]:
+            for user in users:
+                plug.handle_usercreated(user)
+
     def event_userremoved(self, user):
         """A user has left the building.
 
@@ -353,28 +997,40 @@ class Shirk(irc.IRCClient):
         with the bot.
 
         """
-        for plug in self.hooks[Event.userremoved]:
+        for plug in self.dispatch[Event.userremoved]:
             plug.handle_userremoved(user)
 
     def event_userrenamed(self, user, oldnick):
         """A user has changed their nickname."""
-        for plug in self.hooks[Event.userrenamed]:
+        for plug in self.dispatch[Event.userrenamed]:
             plug.handle_userrenamed(user, oldnick)
 
     ## Things modules will want to use
 
-    def add_command(self, cmd, plug):
+    def add_command(self, cmd, plug, aliases=(), cost=1):
         """Add a callback for a specific !commmand.
 
         cmd: The command that should trigger the callback, without the leading
             prefix (so 'command', not '!command')
         plug: The plug that wants to be notified.  See plugbase for a
             description of the arguments.
+        aliases: Other names the command goes by.
+        cost: How much the command counts towards the flood limits.
+
+        """
+        self._add_hook(Event.command, cmd, plug)
+        self.router.add(cmd, aliases, cost)
+
+    def add_match(self, key, plug):
+        """Call plug for channel messages that match a pattern.
+
+        key: (pattern, flags, channels) as set up by plugbase.match, where
+            channels is a tuple of channel names or None for all channels.
+        plug: The plug that wants to be notified.
 
         """
-        if cmd not in self.hooks[Event.command]:
-            self.hooks[Event.command][cmd] = set()
-        self.hooks[Event.command][cmd].add(plug)
+        self._add_hook(Event.match, key, plug)
+        self.matcher.invalidate()
 
     def add_callback(self, event, plug):
         """Add a callback for a given event.
@@ -391,10 +1047,13 @@ class Shirk(irc.IRCClient):
         doesn't exist.
 
         """
-        if event not in self.hooks:
+        if event not in self._simple_events:
             return False
         else:
-            self.hooks[event].add(plug)
+            if plug not in self.hooks[event]:
+                self.hooks[event].append(plug)
+                self._update_dispatch(event)
+                self.generation += 1
             return True
 
     def add_raw(self, cmd, plug):
@@ -408,9 +1067,191 @@ class Shirk(irc.IRCClient):
         plug: the plug that wants to be notified.
 
         """
-        if cmd not in self.hooks[Event.raw]:
-            self.hooks[Event.raw][cmd] = set()
-        self.hooks[Event.raw][cmd].add(plug)
+        self._add_hook(Event.raw, cmd, plug)
+
+    def remove_hook(self, event, plug, cmd=None):
+        """Remove a single callback added with add_command, add_raw,
+        add_match or add_callback.
+
+        For Event.command and Event.raw, cmd is the command or raw IRC
+        command the plug should no longer be called for, for Event.match
+        it's the pattern's key.
+
+        """
+        if cmd is None:
+            callbacks = self.hooks[event]
+        else:
+            callbacks = self.hooks[event].get(cmd, [])
+        if plug in callbacks:
+            callbacks.remove(plug)
+            self.generation += 1
+            if cmd is None:
+                self._update_dispatch(event)
+            else:
+                self.dispatch[event][cmd] = tuple(callbacks)
+                if event == Event.command:
+                    if callbacks:
+                        self.router.invalidate()
+                    else:
+                        self.router.remove(cmd)
+                elif event == Event.match:
+                    self.matcher.invalidate()
+
+    def _add_hook(self, event, cmd, plug):
+        """Register plug for cmd under a keyed event (command, raw or match).
+
+        Plugs are called in the order they registered, and the dispatch tuple
+        for cmd is rebuilt right away so the next line sees the change.
+
+        """
+        callbacks = self.hooks[event].setdefault(cmd, [])
+        if plug not in callbacks:
+            callbacks.append(plug)
+            self.dispatch[event][cmd] = tuple(callbacks)
+            self.generation += 1
+
+    def _update_dispatch(self, event):
+        """Rebuild the dispatch tuple for a simple event.
+
+        Also keeps self.unbatched up to date when event is, or has, a batched
+        counterpart.
+
+        """
+        self.dispatch[event] = tuple(self.hooks[event])
+        for batch, single in self._batch_events.iteritems():
+            if event in (batch, single):
+                self.unbatched[batch] = tuple(plug for plug
+                    in self.hooks[single] if plug not in self.hooks[batch])
+
+
+class Networks(object):
+    """All the networks this process is connected to.
+
+    There's one ShirkFactory per network, each with its own connection,
+    Users and plugs.  This keeps track of the factories so the reactor is
+    only stopped once every one of them is done, and holds what they share:
+    the thread pool, the plug config files and stores and the plugs listed
+    in config['shared_plugs'].
+
+    A shared plug is loaded once and hooked into every network that loads
+    it.  Its self.core is whichever network it's handling right now (see
+    plugbase.current_core), so it mustn't keep per-network state of its
+    own.  It's only cleaned up once the last network lets go of it.
+
+    """
+    def __init__(self, threads=4, plugconf_interval=5, log=None):
+        self.log = log or logging.getLogger('shirk')
+        self.factories = []
+        self.restart = False
+        self.threads = threads
+        self.threadpool = None
+        # path -> store.Database
+        self.databases = {}
+        # plugname -> (plug, set of Shirk instances using it)
+        self.shared = {}
+        self.confstore = confstore.ConfigStore(interval=plugconf_interval,
+                                               log=self.log)
+
+    def add(self, factory):
+        factory.networks = self
+        self.factories.append(factory)
+
+    def connect(self):
+        self.confstore.start()
+        for factory in self.factories:
+            reactor.connectTCP(factory.config['server'],
+                               factory.config['port'], factory)
+
+    def finished(self, factory):
+        """factory has shut down or given up, stop when it's the last one."""
+        if factory in self.factories:
+            self.factories.remove(factory)
+        self.restart = self.restart or factory.restart
+        if not self.factories:
+            self.confstore.stop()
+            reactor.stop()
+
+    def shutdown(self, msg, exclude=None):
+        """Shut down every network but `exclude`."""
+        for factory in list(self.factories):
+            if factory is exclude:
+                continue
+            if factory.bot is not None:
+                factory.bot.shutdown(msg)
+            else:
+                # Not connected right now, so there's nobody to quit.
+                factory.shuttingdown = True
+                factory.stopTrying()
+                self.finished(factory)
+
+    def get_threadpool(self):
+        """Return the thread pool for threaded plug handlers.
+
+        It's only started when first needed and is kept across reconnects.
+
+        """
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(0, self.threads, name='shirk')
+            self.threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.threadpool.stop)
+        return self.threadpool
+
+    def get_database(self, path, interval):
+        """Return the plug store database at path, opening it if needed.
+
+        Like the thread pool it's kept across reconnects, and closed when
+        the reactor shuts down.
+
+        """
+        database = self.databases.get(path)
+        if database is None:
+            database = self.databases[path] = store.Database(path, interval,
+                                                             self.log)
+            database.open()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          database.close)
+        return database
+
+    def shared_plug(self, plugname):
+        """The shared instance of plugname, or None if it isn't loaded."""
+        entry = self.shared.get(plugname)
+        return entry[0] if entry is not None else None
+
+    def users_of(self, plugname):
+        """The Shirk instances using the shared plug plugname."""
+        entry = self.shared.get(plugname)
+        return set(entry[1]) if entry is not None else set()
+
+    def share(self, plugname, plug, core):
+        """Register core as a user of the shared plug.
+
+        If plug replaces a previous instance, the networks that were using
+        that are moved over as well.  Returns every network that now uses
+        plug.
+
+        """
+        entry = self.shared.get(plugname)
+        if entry is None or entry[0] is not plug:
+            cores = set(entry[1]) if entry is not None else set()
+            entry = self.shared[plugname] = (plug, cores)
+        entry[1].add(core)
+        return set(entry[1])
+
+    def release(self, plugname, plug, core):
+        """core is done with plug.  Returns whether plug should clean up.
+
+        That's when it isn't shared or when core was the last one using it.
+
+        """
+        entry = self.shared.get(plugname)
+        if entry is None or entry[0] is not plug:
+            return True
+        entry[1].discard(core)
+        if entry[1]:
+            return False
+        del self.shared[plugname]
+        return True
 
 
 class ShirkFactory(protocol.ReconnectingClientFactory):
@@ -419,7 +1260,7 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
     A new protocol instance will be created each time we connect to the server.
 
     """
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, networks=None):
         self.shuttingdown = False
         self.restart = False
         self.config = config
@@ -430,6 +1271,31 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
         self.initialDelay = config['reconn_delay']
         self.delay = self.initialDelay
         self.maxRetries = config['reconn_tries']
+        self.recorder = None
+        # The connected Shirk instance, if any.
+        self.bot = None
+        if networks is None:
+            networks = Networks(config['threads'],
+                                config['plugconf_interval'], logger)
+        networks.add(self)
+
+    def get_recorder(self):
+        """Return the traffic recorder, or None if recording is off.
+
+        Like the thread pool it's started when first needed and kept across
+        reconnects, so one run of the bot ends up in one series of capture
+        files.
+
+        """
+        if self.recorder is None and self.config['record_dir']:
+            self.recorder = recorder.Recorder(self.config['record_dir'],
+                max_bytes=self.config['record_max_bytes'],
+                max_age=self.config['record_max_age'],
+                keep=self.config['record_keep'], log=self.log)
+            self.recorder.start()
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                                          self.recorder.stop)
+        return self.recorder
 
     def buildProtocol(self, addr):
         p = Shirk()
@@ -441,13 +1307,13 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
         """If we get disconnected, reconnect to server."""
         if self.shuttingdown:
             self.log.info('Shutting down')
-            reactor.stop()
+            self.networks.finished(self)
         else:
             self.log.info('Lost connection.')
             protocol.ReconnectingClientFactory.clientConnectionLost(
                 self, connector, reason)
-            self.log.info('Attempting reconnection in %d seconds.'
-                % (self.delay,))
+            self.log.info('Attempting reconnection in %d seconds.',
+                self.delay)
 
     def clientConnectionFailed(self, connector, reason):
         """Failed to connect to the server, so try to reconnect.
@@ -459,44 +1325,16 @@ class ShirkFactory(protocol.ReconnectingClientFactory):
         protocol.ReconnectingClientFactory.clientConnectionFailed(
             self, connector, reason)
         if self.maxRetries is not None and (self.retries > self.maxRetries):
-            self.log.error('Abandoning reconnection after %d tries'
-                % (self.retries,))
-            reactor.stop()
+            self.log.error('Abandoning reconnection after %d tries',
+                self.retries)
+            self.networks.finished(self)
         else:
-            self.log.info('Attempting reconnection in %d seconds.'
-                % (self.delay,))
+            self.log.info('Attempting reconnection in %d seconds.',
+                self.delay)
 
 
 if __name__ == '__main__':
-    # set up default config dictionary
-    config = {
-        # The nickname to use
-        'nickname': 'shirk',
-        # Password to send while connecting.  Many servers pass this on to
-        # Nickserv.
-        'password': '',
-        # The bot's "real" name
-        'realname': 'Fedmahn',
-        # Username, generally useless unless there's an identd server running.
-        'username': 'shirk',
-        # Debug level: 0 -> warnings, 1 -> info, 2 -> full debug
-        'debug': 0,
-        # Channels to join at first
-        'channels': [],
-        'server': 'chat.freenode.net',
-        'port': 6667,
-        # The plugs to load at startup.
-        'plugs': ['Core', 'Auth'],
-        # The prefix for !commands (or +commands, or @commands, or..)
-        'cmd_prefix': '!',
-        # Initial delay between reconnections when there's a connection
-        # failure.
-        'reconn_delay': 1,
-        # Maximum reconnection retries
-        'reconn_tries': 8,
-        # charset used to decode messages
-        'charset': 'utf-8'
-    }
+    config = dict(DEFAULT_CONFIG)
     config.update(json.load(open('conf.json')))
 
     loglevel = {0: logging.WARNING,
@@ -506,24 +1344,48 @@ if __name__ == '__main__':
     logger.setLevel(loglevel)
     consolelog = logging.StreamHandler()
     consolelog.setLevel(logging.DEBUG)
-    filelog = logging.FileHandler('shirk.log', encoding='utf-8')
+    filelog = logging.handlers.RotatingFileHandler(config['log_file'],
+        maxBytes=config['log_max_bytes'], backupCount=config['log_backups'],
+        encoding='utf-8')
     filelog.setLevel(logging.INFO)
     consolelog.setFormatter(logging.Formatter(
         fmt='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
         datefmt='%m/%d %H:%M:%S'))
-    filelog.setFormatter(logging.Formatter(
-        fmt='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
-        datefmt='%Y-%m-%d/%H:%M:%S'))
-    logger.addHandler(consolelog)
-    logger.addHandler(filelog)
-
-    # Create and connect the client factory
-    f = ShirkFactory(config, logger)
-    reactor.connectTCP(config['server'], config['port'], f)
+    if config['log_json']:
+        filelog.setFormatter(logqueue.JSONFormatter())
+    else:
+        filelog.setFormatter(logging.Formatter(
+            fmt='%(asctime)s %(levelname)-8s %(name)s: %(message)s',
+            datefmt='%Y-%m-%d/%H:%M:%S'))
+    # Both are written from the listener's thread, not the reactor's.
+    loglistener = logqueue.start(logger, [consolelog, filelog])
+
+    # Create a client factory for every network and connect them
+    networks = Networks(config['threads'], config['plugconf_interval'],
+                        logger)
+    netconfigs = config['networks'] or [{}]
+    for netconfig in netconfigs:
+        netconf = dict(config)
+        netconf.update(netconfig)
+        name = netconf.get('name', netconf['server'])
+        if len(netconfigs) > 1:
+            # Keep the networks' files apart unless told otherwise.
+            if 'snapshot_file' not in netconfig:
+                netconf['snapshot_file'] = 'snapshot-%s.json' % (name,)
+            if 'store_file' not in netconfig:
+                netconf['store_file'] = 'shirk-%s.db' % (name,)
+            if netconf['record_dir'] and 'record_dir' not in netconfig:
+                netconf['record_dir'] = os.path.join(netconf['record_dir'],
+                                                     name)
+            ShirkFactory(netconf, logger.getChild(name), networks)
+        else:
+            ShirkFactory(netconf, logger, networks)
+    networks.connect()
     # Push the big red button
     reactor.run()
     # This doesn't happen until the reactor has finished running
-    if f.restart:
+    loglistener.stop()
+    if networks.restart:
         # Restart flag is True, so exit with code 7 rather than normally with 0
         sys.exit(7)
 
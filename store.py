@@ -0,0 +1,224 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Persistent key/value storage for plugs, see Plug.store.
+
+Everything lives in one SQLite database in WAL mode.  Reads are served from
+memory where possible and otherwise from the database, which is quick
+because WAL readers never wait for the writer.  Writes only go to memory
+right away; every so often they are written to the database in one
+transaction from a thread of its own, so the reactor never waits for the
+disk.  Values are anything json can handle.
+
+Stores are only to be used from the reactor thread.
+
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from Queue import Queue
+
+from twisted.internet import reactor, task
+
+# What's pending for a key that was deleted.
+DELETED = object()
+_MISSING = object()
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS store (
+    plug TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (plug, key)
+) WITHOUT ROWID"""
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    # Safe with WAL, a crash can only lose the last transactions.
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+class Database(object):
+    """The database file, and the thread that writes to it.
+
+    There's one PlugStore per plug name, which outlives the plug so a
+    reloaded plug doesn't lose the writes that were still pending.  Pending
+    writes are passed to the writer thread every `interval` seconds.
+
+    """
+    def __init__(self, path, interval=5, log=None):
+        self.log = (log or logging.getLogger('shirk')).getChild('Store')
+        self.path = path
+        self.interval = interval
+        self.stores = {}
+        self.queue = Queue()
+        self.reader = None
+        self.thread = None
+        self._loop = None
+
+    def open(self):
+        self.reader = connect(self.path)
+        self.reader.execute(SCHEMA)
+        self.reader.commit()
+        self.thread = threading.Thread(target=self._run, name='store')
+        self.thread.daemon = True
+        self.thread.start()
+        if self.interval:
+            self._loop = task.LoopingCall(self.flush)
+            self._loop.start(self.interval, now=False)
+
+    def close(self):
+        """Write out everything that's pending and stop the thread."""
+        if self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
+        if self.thread is not None:
+            self.flush()
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def store(self, plugname):
+        """The PlugStore for plugname."""
+        store = self.stores.get(plugname)
+        if store is None:
+            store = self.stores[plugname] = PlugStore(self, plugname)
+        return store
+
+    def flush(self):
+        for store in self.stores.itervalues():
+            store.flush()
+
+    def read(self, plugname, key):
+        """Return the stored value, or _MISSING if there is none."""
+        row = self.reader.execute(
+            'SELECT value FROM store WHERE plug = ? AND key = ?',
+            (plugname, key)).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    ## The writer thread
+
+    def _run(self):
+        db = connect(self.path)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                store, batch = item
+                try:
+                    self._write(db, store.plugname, batch)
+                except sqlite3.Error:
+                    self.log.exception('Failed to write %d keys for %s',
+                                       len(batch), store.plugname)
+                reactor.callFromThread(store.written, batch)
+        finally:
+            db.close()
+
+    def _write(self, db, plugname, batch):
+        deleted = [(plugname, key) for key, value in batch.iteritems()
+                   if value is DELETED]
+        changed = [(plugname, key, value) for key, value
+                   in batch.iteritems() if value is not DELETED]
+        with db:
+            db.executemany('DELETE FROM store WHERE plug = ? AND key = ?',
+                           deleted)
+            db.executemany('INSERT OR REPLACE INTO store (plug, key, value) '
+                           'VALUES (?, ?, ?)', changed)
+
+
+class PlugStore(object):
+    """One plug's keys and values, used like a dict.
+
+    Keys are strings.  A value that's changed in place has to be stored
+    again for the change to be written, and deleting a key that isn't there
+    is fine.  The values used last are kept in memory, up to `max_cached`
+    of them.  Once `max_pending` writes are waiting they're passed on right
+    away instead of at the next flush.
+
+    """
+    max_cached = 10000
+    max_pending = 5000
+
+    def __init__(self, db, plugname):
+        self.db = db
+        self.plugname = plugname
+        # key -> value or DELETED, most recently used last
+        self.cache = OrderedDict()
+        # key -> json value or DELETED, not passed to the writer yet
+        self.pending = {}
+        # The same, for what's passed on but not written yet.
+        self.writing = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.cache.pop(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+        else:
+            value = self.pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self.writing.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                value = self.db.read(self.plugname, key)
+                if value is _MISSING:
+                    value = DELETED
+            elif value is not DELETED:
+                value = json.loads(value)
+        # Keys that aren't there are cached as well, as DELETED, so asking
+        # for them again doesn't hit the database.
+        self._cache(key, value)
+        return default if value is DELETED else value
+
+    def __getitem__(self, key):
+        value = self.get(key, DELETED)
+        if value is DELETED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, DELETED) is not DELETED
+
+    def __setitem__(self, key, value):
+        # Encoded right away so unsuitable values fail here.
+        self._set(key, value, json.dumps(value))
+
+    def __delitem__(self, key):
+        self._set(key, DELETED, DELETED)
+
+    def flush(self):
+        """Pass the pending writes on to the writer thread."""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        self.writing.update(batch)
+        self.db.queue.put((self, batch))
+
+    def written(self, batch):
+        """Called once batch is in the database."""
+        for key, value in batch.iteritems():
+            if self.writing.get(key) is value:
+                del self.writing[key]
+
+    def _set(self, key, value, encoded):
+        self._cache(key, value)
+        self.pending[key] = encoded
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def _cache(self, key, value):
+        self.cache.pop(key, None)
+        self.cache[key] = value
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
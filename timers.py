@@ -0,0 +1,212 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Timers for plugs, see Plug.call_later and Plug.call_every.
+
+Rather than each one going into the reactor's heap, plug timers go on a
+hierarchical timing wheel: `levels` wheels of 2 ** `bits` slots each, where
+a slot on the first wheel is one tick of `resolution` seconds and a slot on
+every next wheel is as long as all of the previous wheel.  Adding or
+cancelling a timer puts it in or takes it out of a slot, whatever the number
+of timers.  When a wheel comes round, the next slot of the wheel above it is
+emptied onto the lower wheels.
+
+The wheel only has the reactor wake it up when something is due or the
+first wheel comes round, and not at all when it's empty.
+
+"""
+
+import logging
+import math
+
+from twisted.internet import reactor
+
+
+class Timer(object):
+    """A call on a TimingWheel.  cancel() it to stop it from happening."""
+    __slots__ = ('wheel', 'expires', 'interval', 'f', 'args', 'kw', 'slot',
+                 'owner', 'cancelled')
+
+    def __init__(self, wheel, expires, interval, f, args, kw, owner):
+        self.wheel = wheel
+        # In ticks.
+        self.expires = expires
+        self.interval = interval
+        self.f = f
+        self.args = args
+        self.kw = kw
+        # The set it's in on the wheel, if any.
+        self.slot = None
+        # A set of timers to remove it from when it's done, see Plug.
+        self.owner = owner
+        self.cancelled = False
+
+    def active(self):
+        return not self.cancelled and (self.slot is not None or
+                                       self.interval is not None)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+        self._release()
+
+    def _release(self):
+        if self.owner is not None:
+            self.owner.discard(self)
+            self.owner = None
+
+
+class TimingWheel(object):
+    """Runs Timers.
+
+    `run` is called as run(f, args, kw) to make each call, which is how the
+    core gets to make itself the current core for shared plugs.  Errors are
+    logged.
+
+    """
+    resolution = 0.1
+    bits = 6
+    levels = 4
+
+    def __init__(self, run=None, log=None):
+        self.run = run or (lambda f, args, kw: f(*args, **kw))
+        self.log = log or logging.getLogger('TimingWheel')
+        self.size = 1 << self.bits
+        self.mask = self.size - 1
+        self.wheels = [[set() for i in xrange(self.size)]
+                       for level in xrange(self.levels)]
+        self.start = reactor.seconds()
+        # The next tick to run.
+        self.tick = 0
+        self.count = 0
+        self._call = None
+        self._wake = None
+
+    def call_later(self, delay, f, *args, **kw):
+        return self.schedule(delay, None, f, args, kw)
+
+    def call_every(self, interval, f, *args, **kw):
+        return self.schedule(interval, interval, f, args, kw)
+
+    def schedule(self, delay, interval, f, args, kw, owner=None):
+        """Call f(*args, **kw) in `delay` seconds.
+
+        If interval isn't None, it's called again every `interval` seconds
+        after that until the Timer that's returned is cancelled.
+
+        """
+        now = reactor.seconds()
+        if not self.count:
+            # Don't make the first _run catch up on the time it was idle.
+            self.tick = max(self.tick, self._ticks(now))
+        # Rounded up, timers may be late but never early.
+        expires = int(math.ceil((now + delay - self.start) / self.resolution
+                                - 1e-9))
+        if interval is not None:
+            interval = max(1, int(round(interval / self.resolution)))
+        timer = Timer(self, max(expires, self.tick), interval, f, args, kw,
+                      owner)
+        if owner is not None:
+            owner.add(timer)
+        self._add(timer)
+        self._schedule()
+        return timer
+
+    def stop(self):
+        """Cancel every timer."""
+        for wheel in self.wheels:
+            for slot in wheel:
+                for timer in list(slot):
+                    timer.cancel()
+        self._schedule()
+
+    def _add(self, timer):
+        delta = timer.expires - self.tick
+        for level in xrange(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                index = (timer.expires >> (self.bits * level)) & self.mask
+                break
+        else:
+            # Further away than the wheels reach, so it goes in the top
+            # wheel's slot that comes round last and is put back from there.
+            index = ((self.tick >> (self.bits * level)) - 1) & self.mask
+        slot = self.wheels[level][index]
+        slot.add(timer)
+        timer.slot = slot
+        self.count += 1
+
+    def _take(self, level, index):
+        slot = self.wheels[level][index]
+        if not slot:
+            return ()
+        self.wheels[level][index] = set()
+        for timer in slot:
+            timer.slot = None
+        self.count -= len(slot)
+        return slot
+
+    def _cascade(self):
+        """Move the timers that are getting close down a wheel or more."""
+        level = 1
+        while level < self.levels and \
+                self.tick & ((1 << (self.bits * level)) - 1) == 0:
+            level += 1
+        for level in xrange(level - 1, 0, -1):
+            index = (self.tick >> (self.bits * level)) & self.mask
+            for timer in self._take(level, index):
+                self._add(timer)
+
+    def _run(self):
+        self._call = None
+        now = self._ticks(reactor.seconds())
+        while self.tick <= now and self.count:
+            self._cascade()
+            due = self._take(0, self.tick & self.mask)
+            self.tick += 1
+            for timer in due:
+                self._fire(timer)
+        self._schedule()
+
+    def _ticks(self, seconds):
+        return int((seconds - self.start) / self.resolution + 1e-9)
+
+    def _fire(self, timer):
+        if timer.cancelled:
+            # By something else that was due at the same time.
+            return
+        try:
+            self.run(timer.f, timer.args, timer.kw)
+        except Exception:
+            self.log.exception('Error in timer %r', timer.f)
+        if timer.interval is not None and not timer.cancelled:
+            timer.expires = max(timer.expires + timer.interval, self.tick)
+            self._add(timer)
+        else:
+            timer._release()
+
+    def _schedule(self):
+        """Have the reactor wake us up for the next tick that matters."""
+        if not self.count:
+            if self._call is not None:
+                self._call.cancel()
+                self._call = None
+            return
+        # The next tick with something in it on the first wheel, or else
+        # the next cascade, which may be the next tick.
+        wake = self.tick
+        if wake & self.mask:
+            end = (wake | self.mask) + 1
+            while wake < end and not self.wheels[0][wake & self.mask]:
+                wake += 1
+        when = self.start + wake * self.resolution
+        delay = max(0, when - reactor.seconds())
+        if self._call is None:
+            self._call = reactor.callLater(delay, self._run)
+        elif wake != self._wake:
+            self._call.reset(delay)
+        self._wake = wake
@@ -1,10 +1,61 @@
 # Copyright (c) 2012 Dominic van Berkel
 # See LICENSE for details.
 
+import json
 import logging
+import os
+import re
+import string
+import time
+from collections import OrderedDict
+
+# A netsplit QUIT message is nothing but the names of the two servers that
+# lost each other, as in "irc.example.net hub.example.net", or masked like
+# "*.net *.split" on networks that hide their servers.  Real names need at
+# least three labels so that quit messages like "lol.wut ok.then" don't
+# count.
+_LABEL = r'[a-z0-9](?:[a-z0-9-]*[a-z0-9])?'
+_SERVER = r'(?:\*(?:\.%s)+|%s(?:\.%s){2,})' % (_LABEL, _LABEL, _LABEL)
+NETSPLIT = re.compile(r'%s %s\Z' % (_SERVER, _SERVER), re.IGNORECASE)
+
+
+def is_netsplit(message):
+    """Is message the QUIT message of a user lost in a netsplit?
+
+    >>> is_netsplit('irc.example.net hub.example.net')
+    True
+    >>> is_netsplit('*.net *.split')
+    True
+    >>> is_netsplit('lol.wut ok.then')
+    False
+    >>> is_netsplit('Quit: irc.example.net hub.example.net')
+    False
+    >>> is_netsplit('*.net *.split and then some')
+    False
+
+    """
+    return NETSPLIT.match(message) is not None
+
+
+def _casemapping(upper, lower):
+    """Build the translate() tables for str and unicode for a casemapping."""
+    upper = string.ascii_uppercase + upper
+    lower = string.ascii_lowercase + lower
+    return (string.maketrans(upper, lower),
+            dict((ord(u), ord(l)) for u, l in zip(upper, lower)))
+
+# The CASEMAPPINGs from RPL_ISUPPORT that we know how to fold.
+CASEMAPPINGS = {'ascii': _casemapping('', ''),
+                'strict-rfc1459': _casemapping('[]\\', '{}|'),
+                'rfc1459': _casemapping('[]\\~', '{}|^')}
 
 
 class User(object):
+    # There's one of these for every user the bot can see, so keep them
+    # small.  __dict__ is there for the attributes plugs add.  power is read
+    # by plugbase.command, so it has a slot of its own.
+    __slots__ = ('nickname', 'username', 'hostmask', 'channels', 'alive',
+                 'uid', 'power', '__dict__', '__weakref__')
     _uid = 0
 
     def __init__(self, nickname, username, hostmask, channel):
@@ -14,6 +65,7 @@ class User(object):
         self.channels = set([channel])
         self.alive = True
         self.uid = self.next_uid()
+        self.power = 0
 
     @classmethod
     def next_uid(cls):
@@ -32,58 +84,340 @@ class Users(object):
     with. It is recommended that plugs don't keep single User objects around
     but instead at most a reference to the collective users dict.
 
+    Channel membership is indexed both ways: User.channels holds the
+    channels a user is in, and Users.channels maps a channel to the set of
+    Users in it.  Channel names are stored once, as the key in that dict, and
+    shared by every User in the channel.
+
+    Users who quit in a netsplit aren't deleted right away.  They're kept
+    aside for the core's `netsplit_grace` seconds, and if they come back in
+    that time they get their old User instance back, along with anything
+    plugs stored on it, without any usercreated or userremoved events.
+
+    Nicknames and channels are compared according to the server's
+    CASEMAPPING, so all the dicts here are keyed by the folded name (see
+    fold).  User.nickname keeps the nick as the user wrote it, while
+    User.channels holds the folded channel names.
+
+    Before a restart the user table can be written to disk with
+    save_snapshot, and read back by the new process with load_snapshot.
+    Users seen again with the same nick and user@host get the attributes
+    plugs stored on them back, and are marked with `restored = True` so
+    plugs can skip work they already did.
+
     """
     def __init__(self, core):
         self.log = logging.getLogger('Users')
         self.core = core
         self.users_by_nick = {}
         self.users_by_uid = {}
+        # channel -> set of Users
+        self.channels = {}
+        # channel -> the same channel, see _channel_name
+        self._channel_names = {}
+        # nickname -> (User, expiry time) for users lost in a netsplit, in
+        # the order they split.
+        self.split_users = OrderedDict()
+        self._split_call = None
+        self.casemapping = 'rfc1459'
+        self._fold_str, self._fold_unicode = CASEMAPPINGS['rfc1459']
+        # folded nick -> (nickname, username, hostmask, attrs) from
+        # load_snapshot, and the time after which those are too old to be
+        # trusted.
+        self.restorable = {}
+        self._restore_until = 0
+
+    def fold(self, name):
+        """Return the case-folded version of a nickname or channel."""
+        if isinstance(name, unicode):
+            return name.translate(self._fold_unicode)
+        return name.translate(self._fold_str)
+
+    def set_casemapping(self, casemapping):
+        """Switch to the server's CASEMAPPING and rebuild the indexes."""
+        if casemapping not in CASEMAPPINGS:
+            self.log.warning('Unknown casemapping %s, sticking with %s',
+                casemapping, self.casemapping)
+            return
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self._fold_str, self._fold_unicode = CASEMAPPINGS[casemapping]
+        fold = self.fold
+        self.users_by_nick = dict((fold(user.nickname), user)
+                                  for user in self.users_by_nick.itervalues())
+        self.split_users = OrderedDict((fold(user.nickname), (user, expiry))
+            for user, expiry in self.split_users.itervalues())
+        channels, self.channels = self.channels, {}
+        self._channel_names = {}
+        for channel, members in channels.iteritems():
+            self.channels.setdefault(self._channel_name(channel), set()
+                ).update(members)
+        for user in self.users_by_uid.itervalues():
+            user.channels = set(self._channel_name(channel)
+                                for channel in user.channels)
+        self.restorable = dict((fold(saved[0]), saved)
+                               for saved in self.restorable.itervalues())
+        self.log.info('Using casemapping %s', casemapping)
+
+    def cleanup(self):
+        """Stop the netsplit timer, for when the connection goes away."""
+        if self._split_call is not None and self._split_call.active():
+            self._split_call.cancel()
+        self._split_call = None
+
+    def save_snapshot(self, path):
+        """Write the user table and plug attributes to path as JSON.
+
+        Only attributes with simple values (numbers, strings, booleans and
+        None) are saved.
+
+        """
+        simple = (int, long, float, bool, basestring, type(None))
+        entries = []
+        for user in self.users_by_uid.itervalues():
+            attrs = dict((k, v) for k, v in user.__dict__.iteritems()
+                         if isinstance(v, simple) and k != 'restored')
+            attrs['power'] = user.power
+            entries.append([user.nickname, user.username, user.hostmask,
+                            attrs])
+        with open(path, 'w') as f:
+            json.dump({'time': time.time(), 'users': entries}, f,
+                      separators=(',', ':'))
+        self.log.info('Saved %d users to %s', len(entries), path)
+
+    def load_snapshot(self, path, max_age):
+        """Read a snapshot written by save_snapshot, if there is one.
+
+        Nothing is restored right away.  The entries are kept for max_age
+        seconds from when the snapshot was written and used as the users
+        show up again.  The file is removed so it's only ever used once.
+
+        """
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except IOError:
+            return
+        except ValueError:
+            self.log.warning('Ignoring broken snapshot %s', path)
+        else:
+            try:
+                self._restore_until = snapshot['time'] + max_age
+                if self._restore_until > time.time():
+                    for nickname, username, hostmask, attrs in \
+                            snapshot['users']:
+                        self.restorable[self.fold(nickname)] = (nickname,
+                            username, hostmask, dict(attrs))
+                    self.log.info('Loaded %d users from %s',
+                        len(self.restorable), path)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                # Valid JSON, but not a snapshot.
+                self.log.warning('Ignoring broken snapshot %s', path)
+                self.restorable.clear()
+                self._restore_until = 0
+        try:
+            os.remove(path)
+        except OSError as e:
+            self.log.warning('Failed to remove snapshot %s: %s', path, e)
+
+    def _restore(self, key, user):
+        """Give a new user their attributes from the snapshot, if any."""
+        if time.time() > self._restore_until:
+            self.restorable.clear()
+            return
+        saved = self.restorable.pop(key, None)
+        if saved is not None and saved[1:3] == (user.username, user.hostmask):
+            for attr, value in saved[3].iteritems():
+                setattr(user, attr, value)
+            user.restored = True
 
     def by_nick(self, nickname):
-        return self.users_by_nick.get(nickname)
+        if isinstance(nickname, unicode):
+            return self.users_by_nick.get(
+                nickname.translate(self._fold_unicode))
+        return self.users_by_nick.get(nickname.translate(self._fold_str))
 
     def by_uid(self, uid):
         return self.users_by_uid.get(uid)
 
+    def members(self, channel):
+        """Return a frozenset of the Users in channel."""
+        return frozenset(self.channels.get(self.fold(channel), ()))
+
+    def common_members(self, *channels):
+        """Return a set of the Users who are in all of the given channels.
+
+        Starts from the smallest channel, so this takes time in proportion to
+        that channel's size.
+
+        """
+        sets = sorted((self.channels.get(self.fold(channel), set())
+                       for channel in channels), key=len)
+        if not sets:
+            return set()
+        return sets[0].intersection(*sets[1:])
+
+    def drop_channel(self, channel):
+        """Forget about a channel, usually because the bot left it.
+
+        Everyone who's no longer in any channel the bot is in gets deleted.
+
+        """
+        channel = self.fold(channel)
+        members = self.channels.pop(channel, ())
+        self._channel_names.pop(channel, None)
+        for user in members:
+            user.channels.discard(channel)
+            if not user.channels:
+                self.delete_user(user)
+        self.log.debug('Dropped channel %s with %d users',
+            channel, len(members))
+
+    def _channel_name(self, channel):
+        """Return the one folded string that's used for channel everywhere.
+
+        That way each User.channels holds references to a shared string
+        rather than a copy of its own.
+
+        """
+        channel = self.fold(channel)
+        try:
+            return self._channel_names[channel]
+        except KeyError:
+            self._channel_names[channel] = channel
+            self.channels[channel] = set()
+            return channel
+
     def user_joined(self, nickname, username, hostmask, channel):
-        if nickname in self.users_by_nick:
-            self.users_by_nick[nickname].channels.add(channel)
-            self.log.debug('Added user %s to channel %s'
-                % (nickname, channel))
+        user = self._add_user(nickname, username, hostmask, channel)
+        if user is not None:
+            self.core.event_usercreated(user)
+
+    def users_joined(self, channel, who):
+        """Add a whole batch of users to a channel at once.
+
+        `who` is a list of (nickname, username, hostmask) tuples, typically
+        collected from WHO replies.  Any users that weren't known yet are
+        announced with a single userscreated event.  Returns the list of
+        nicknames.
+
+        """
+        created = []
+        for nickname, username, hostmask in who:
+            user = self._add_user(nickname, username, hostmask, channel)
+            if user is not None:
+                created.append(user)
+        if created:
+            self.core.event_userscreated(created)
+        return [nickname for nickname, username, hostmask in who]
+
+    def _add_user(self, nickname, username, hostmask, channel):
+        """Add a user to a channel, creating the User if necessary.
+
+        Returns the new User, or None if the user was already known.
+
+        """
+        channel = self._channel_name(channel)
+        key = self.fold(nickname)
+        if key in self.split_users:
+            user, expiry = self.split_users.pop(key)
+            if (user.username, user.hostmask) == (username, hostmask):
+                user.channels.add(channel)
+                self._index(user)
+                self.log.debug('User %s (uid=%d) is back from a netsplit',
+                    nickname, user.uid)
+                return None
+            # Someone else took the nick, so the old one isn't coming back.
+            self._removed(user)
+        if key in self.users_by_nick:
+            user = self.users_by_nick[key]
+            user.channels.add(channel)
+            self.channels[channel].add(user)
+            self.log.debug('Added user %s to channel %s',
+                nickname, channel)
+            return None
         else:
             user = User(nickname, username, hostmask, channel)
-            self.users_by_nick[nickname] = user
-            self.users_by_uid[user.uid] = user
-            self.core.event_usercreated(user)
+            if self.restorable:
+                self._restore(key, user)
+            self._index(user)
             msg = 'Added user %s (uid=%d) to the global userlist, channel %s'
-            self.log.debug(msg % (nickname, user.uid, channel))
+            self.log.debug(msg, nickname, user.uid, channel)
+            return user
 
     def user_left(self, nickname, channel):
         """A user is no longer in a channel due to a part or kick."""
-        if nickname in self.users_by_nick:
-            user = self.users_by_nick[nickname]
+        user = self.by_nick(nickname)
+        if user is not None:
+            channel = self.fold(channel)
             user.channels.discard(channel)
-            self.log.debug('Removed channel %s from user %s'
-                % (channel, nickname))
+            self._leave(user, channel)
+            self.log.debug('Removed channel %s from user %s',
+                channel, nickname)
             if not user.channels:
                 self.delete_user(user)
 
     def user_quit(self, nickname):
         """A user has quit."""
-        if nickname in self.users_by_nick:
-            user = self.users_by_nick[nickname]
+        user = self.by_nick(nickname)
+        if user is not None:
+            for channel in user.channels:
+                self._leave(user, channel)
             user.channels.clear()
             self.delete_user(user)
 
+    def user_split(self, nickname):
+        """A user has quit in a netsplit.
+
+        The user disappears from the indexes but is only deleted once the
+        grace period is over without them coming back.
+
+        """
+        user = self.by_nick(nickname)
+        if user is not None:
+            self._unindex(user)
+            user.channels.clear()
+            expiry = time.time() + self.core.config['netsplit_grace']
+            self.split_users[self.fold(nickname)] = (user, expiry)
+            if self._split_call is None:
+                self._split_call = self.core.callLater(
+                    self.core.config['netsplit_grace'], self._expire_splits)
+            self.log.debug('User %s (uid=%d) lost in a netsplit',
+                nickname, user.uid)
+
+    def _expire_splits(self):
+        """Delete the users whose netsplit grace period is over."""
+        self._split_call = None
+        now = time.time()
+        while self.split_users:
+            nickname = next(iter(self.split_users))
+            user, expiry = self.split_users[nickname]
+            if expiry > now:
+                self._split_call = self.core.callLater(expiry - now,
+                                                       self._expire_splits)
+                break
+            del self.split_users[nickname]
+            self._removed(user)
+
+    def _leave(self, user, channel):
+        """Take user out of channel's member set."""
+        members = self.channels.get(channel)
+        if members is not None:
+            members.discard(user)
+
     def user_nickchange(self, oldnick, newnick):
         """A user has changed their nickname."""
-        if oldnick in self.users_by_nick:
-            user = self.users_by_nick[oldnick]
+        oldkey, newkey = self.fold(oldnick), self.fold(newnick)
+        if newkey in self.split_users:
+            # Someone took the nick of a user who's lost in a netsplit.
+            self._removed(self.split_users.pop(newkey)[0])
+        if oldkey in self.users_by_nick:
+            user = self.users_by_nick.pop(oldkey)
             user.nickname = newnick
-            self.users_by_nick[newnick] = user
-            del self.users_by_nick[oldnick]
-            self.log.debug('Changed nickname of %s to %s'
-                % (oldnick, newnick))
+            self.users_by_nick[newkey] = user
+            self.log.debug('Changed nickname of %s to %s',
+                oldnick, newnick)
             self.core.event_userrenamed(user, oldnick)
 
     def delete_user(self, user):
@@ -93,8 +427,25 @@ class Users(object):
         reference to the user can know it's not valid anymore.
 
         """
-        user.alive = False
-        del self.users_by_nick[user.nickname]
+        self._unindex(user)
+        self._removed(user)
+
+    def _index(self, user):
+        """Add user to the nick, uid and channel indexes."""
+        self.users_by_nick[self.fold(user.nickname)] = user
+        self.users_by_uid[user.uid] = user
+        for channel in user.channels:
+            self.channels[channel].add(user)
+
+    def _unindex(self, user):
+        """Remove user from the nick, uid and channel indexes."""
+        for channel in user.channels:
+            self._leave(user, channel)
+        del self.users_by_nick[self.fold(user.nickname)]
         del self.users_by_uid[user.uid]
+
+    def _removed(self, user):
+        """Mark user as dead and tell the plugs it's gone."""
+        user.alive = False
         self.core.event_userremoved(user)
-        self.log.debug('Removed user %s (uid=%d)' % (user.nickname, user.uid))
+        self.log.debug('Removed user %s (uid=%d)', user.nickname, user.uid)
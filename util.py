@@ -8,9 +8,12 @@ class Event:
     addressed = 'event_addressed'
     chanmsg = 'event_chanmsg'
     command = 'event_command'
+    match = 'event_match'
     private = 'event_private'
     raw = 'event_raw'
     userjoined = 'event_userjoined'
+    usersjoined = 'event_usersjoined'
     usercreated = 'event_usercreated'
+    userscreated = 'event_userscreated'
     userremoved = 'event_userremoved'
     userrenamed = 'event_userrenamed'
@@ -0,0 +1,521 @@
+# Copyright (c) 2012 Dominic van Berkel
+# See LICENSE for details.
+
+"""Plugs that run in a process of their own.
+
+Plugs listed in config['worker_plugs'] aren't imported by the core.  Instead
+a WorkerPlug stands in for them and runs this module as a subprocess, which
+loads the real plug:
+
+    python workers.py <plugname>
+
+The core and the worker talk over a pair of pipes (fds 3 and 4 in the
+worker, so whatever the plug prints doesn't get in the way) using marshal
+with a length prefix.  The worker tells the core which commands and events
+the plug hooks, and the core only forwards those.  Whatever the plug sends
+comes back through the core's send queue.
+
+The worker only knows about the users the core told it about along with an
+event (the source of a command, the users in a userscreated batch and so on)
+and any changes the plug makes to them stay in the worker.  Plugs that
+manage users, like Auth, don't belong in a worker.
+
+When a worker dies it's started again after a while, and the bot carries on
+without the plug in the meantime.
+
+"""
+
+import importlib
+import logging
+import marshal
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+from twisted.internet import protocol, reactor, stdio
+from twisted.python import threadable
+from twisted.python.threadpool import ThreadPool
+
+import confstore
+import store
+import timers
+import users
+from util import Event
+
+HEADER = struct.Struct('!I')
+# Anything bigger than this is a bug, not a message.
+MAX_MESSAGE = 16 * 1024 * 1024
+# Tags a User in the arguments of an event.
+USER_TAG = '\0user'
+# Attribute types that survive the trip to the worker.
+SIMPLE_TYPES = (str, unicode, int, long, float, bool, type(None))
+
+
+def frame(message):
+    """Serialize message, ready to be written to the other side."""
+    data = marshal.dumps(message, 2)
+    return HEADER.pack(len(data)) + data
+
+
+class Framer(object):
+    """Splits the incoming byte stream back into messages."""
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        """Add data, return the list of messages that are now complete.
+
+        Raises ValueError on garbage.
+
+        """
+        buf = self.buffer + data
+        messages = []
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            length, = HEADER.unpack_from(buf, pos)
+            if length > MAX_MESSAGE:
+                raise ValueError('Message of %d bytes' % (length,))
+            end = pos + HEADER.size + length
+            if end > len(buf):
+                break
+            messages.append(marshal.loads(buf[pos + HEADER.size:end]))
+            pos = end
+        self.buffer = buf[pos:]
+        return messages
+
+
+def user_record(user):
+    """The parts of a User that a worker gets to see, as a dict."""
+    record = dict((attr, value) for attr, value in user.__dict__.iteritems()
+                  if isinstance(value, SIMPLE_TYPES))
+    record.update(nickname=user.nickname, username=user.username,
+                  hostmask=user.hostmask, channels=list(user.channels),
+                  alive=user.alive, uid=user.uid, power=user.power)
+    return record
+
+
+def encode(value):
+    """Make event arguments safe for marshal, Users included."""
+    if isinstance(value, users.User):
+        return (USER_TAG, user_record(value))
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+## The core's side
+
+class WorkerPlug(object):
+    """Stand-in for a plug that runs in a worker process.
+
+    Hooks whatever the worker asks for and passes the handle_* calls for
+    those on to it, see the module docstring.
+
+    """
+    shared = False
+    # Seconds to wait before starting a crashed worker again, doubling up to
+    # max_respawn_delay while it keeps crashing shortly after starting.
+    respawn_delay = 1
+    max_respawn_delay = 300
+    # A worker that's been up this long is considered healthy again.
+    stable_after = 60
+    # Handlers whose first argument is a nickname, or a list of them.  The
+    # worker gets to know about those users along with the event.
+    _source_args = frozenset(['handle_addressed', 'handle_chanmsg',
+                              'handle_command', 'handle_match',
+                              'handle_private', 'handle_userjoined',
+                              'handle_usersjoined'])
+
+    def __init__(self, core, plugname, startingup=True):
+        self.name = plugname
+        self.core = core
+        self.startingup = startingup
+        self.log = core.log.getChild(plugname)
+        self.worker = None
+        self.stopping = False
+        self.casemapping = None
+        self.delay = self.respawn_delay
+        self.started = 0
+        self._respawn_call = None
+        # (event, command or None) for everything the worker hooked.
+        self.hooked = set()
+
+    def __repr__(self):
+        return '<WorkerPlug %s>' % (self.name,)
+
+    def hook_events(self):
+        """Start the worker, which will tell us what to hook."""
+        self.spawn()
+
+    def spawn(self):
+        self._respawn_call = None
+        self.log.info('Starting worker')
+        self.started = reactor.seconds()
+        # fd 0 is closed right away, 1 and 2 are whatever the plug prints
+        # and 3 and 4 are for messages to and from the worker.
+        reactor.spawnProcess(WorkerProtocol(self), sys.executable,
+            [sys.executable, os.path.abspath(__file__), self.name],
+            env=os.environ, path=os.getcwd(),
+            childFDs={0: 'w', 1: 'r', 2: 'r', 3: 'w', 4: 'r'})
+
+    def restart(self):
+        """Stop the worker and start a new one, to pick up new code."""
+        if self.worker is not None:
+            # worker_ended takes care of starting it again.
+            self.delay = 0
+            self.worker.send(('stop',))
+        elif self._respawn_call is not None:
+            self._respawn_call.reset(0)
+
+    def cleanup(self):
+        self.stopping = True
+        if self._respawn_call is not None:
+            self._respawn_call.cancel()
+            self._respawn_call = None
+        if self.worker is not None:
+            self.worker.send(('stop',))
+
+    ## Called by WorkerProtocol
+
+    def worker_started(self, worker):
+        self.worker = worker
+        self.casemapping = self.core.users.casemapping
+        worker.send(('start', self.name, self.core.config, self.startingup,
+                     self.casemapping, self.core.log.name,
+                     self.core.log.getEffectiveLevel()))
+
+    def worker_message(self, message):
+        kind = message[0]
+        core = self.core
+        if kind == 'msg':
+            target, text, key, ttl = message[1:]
+            core.msg(target, text, key=key, ttl=ttl)
+        elif kind == 'send':
+            line, priority, target, key, ttl = message[1:]
+            core.sendLine(line, priority, target, key, ttl)
+        elif kind == 'log':
+            levelno, name, text = message[1:]
+            logging.getLogger(name).log(levelno, text)
+        elif kind == 'hook':
+            event, cmd, aliases, cost = message[1:]
+            self.hooked.add((event, cmd))
+            if cmd is None:
+                core.add_callback(event, self)
+            elif event == Event.command:
+                core.add_command(cmd, self, aliases, cost)
+            elif event == Event.match:
+                core.add_match(tuple(cmd), self)
+            else:
+                core.add_raw(cmd, self)
+        elif kind == 'unhook':
+            event, cmd = message[1:]
+            self.hooked.discard((event, cmd))
+            core.remove_hook(event, self, cmd)
+        else:
+            self.log.warning('Unknown message from worker: %r', kind)
+
+    def worker_ended(self, worker, reason):
+        if worker is self.worker:
+            self.worker = None
+        for event, cmd in self.hooked:
+            self.core.remove_hook(event, self, cmd)
+        self.hooked.clear()
+        if self.stopping or self.core is None:
+            return
+        if reactor.seconds() - self.started > self.stable_after:
+            self.delay = self.respawn_delay
+        self.log.warning('Worker exited (%s), starting it again in %ds',
+            reason.getErrorMessage(), self.delay)
+        self._respawn_call = self.core.callLater(self.delay, self.spawn)
+        self.delay = min(max(self.delay * 2, self.respawn_delay),
+                         self.max_respawn_delay)
+
+    ## Handlers
+
+    def handle_match(self, source, channel, msg, action, key, match):
+        # Match objects can't be sent, the worker searches again.
+        self.__getattr__('handle_match')(source, channel, msg, action, key,
+                                         None)
+
+    def __getattr__(self, name):
+        """Pass whatever handle_* is called on to the worker."""
+        if not name.startswith('handle_'):
+            raise AttributeError(name)
+        source = name in self._source_args
+        def forward(*args):
+            worker = self.worker
+            if worker is None:
+                return
+            table = self.core.users
+            if table.casemapping != self.casemapping:
+                self.casemapping = table.casemapping
+                worker.send(('casemapping', self.casemapping))
+            known = []
+            if source:
+                nicks = args[0]
+                if not isinstance(nicks, list):
+                    nicks = [nicks]
+                for nick in nicks:
+                    user = table.by_nick(nick)
+                    if user is not None:
+                        known.append(user_record(user))
+            worker.send(('event', name, encode(args), known))
+        return forward
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """The core's end of the pipes to a worker."""
+
+    def __init__(self, plug):
+        self.plug = plug
+        self.framer = Framer()
+        self.output = {1: '', 2: ''}
+
+    def connectionMade(self):
+        self.transport.closeChildFD(0)
+        self.plug.worker_started(self)
+
+    def send(self, message):
+        self.transport.writeToChild(3, frame(message))
+
+    def childDataReceived(self, fd, data):
+        if fd == 4:
+            try:
+                messages = self.framer.feed(data)
+            except ValueError:
+                self.plug.log.exception('Garbage from worker')
+                self.transport.signalProcess('KILL')
+                return
+            for message in messages:
+                self.plug.worker_message(message)
+        elif fd in self.output:
+            lines = (self.output[fd] + data).split('\n')
+            self.output[fd] = lines.pop()
+            for line in lines:
+                self.plug.log.info('worker: %s', line.rstrip('\r'))
+
+    def processEnded(self, reason):
+        self.plug.worker_ended(self, reason)
+
+
+## The worker's side
+
+class WorkerCore(object):
+    """What a plug in a worker gets as self.core.
+
+    Covers what plugs use of Shirk: hooking, sending, the config, the users
+    and the thread pool.
+
+    """
+    def __init__(self, child, config, startingup, casemapping, logname):
+        self.child = child
+        self.config = config
+        self.startingup = startingup
+        self.nickname = config['nickname']
+        self.cmd_prefix = config['cmd_prefix']
+        self.log = logging.getLogger(logname)
+        self.users = WorkerUsers(casemapping)
+        self.plugs = {}
+        # The worker doesn't hear about the core's plugs coming and going,
+        # so plugbase.cached responses only expire.
+        self.generation = 0
+        self.confstore = confstore.ConfigStore(
+            interval=config['plugconf_interval'], log=self.log)
+        self._threadpool = None
+        self._database = None
+        self.timers = timers.TimingWheel(log=self.log.getChild('timers'))
+
+    def send(self, message):
+        if not threadable.isInIOThread():
+            reactor.callFromThread(self.send, message)
+            return
+        self.child.send(message)
+
+    def add_command(self, cmd, plug, aliases=(), cost=1):
+        self.send(('hook', Event.command, cmd, list(aliases), cost))
+
+    def add_raw(self, cmd, plug):
+        self.send(('hook', Event.raw, cmd, [], 1))
+
+    def add_match(self, key, plug):
+        self.send(('hook', Event.match, key, [], 1))
+
+    def add_callback(self, event, plug):
+        self.send(('hook', event, None, [], 1))
+        return True
+
+    def remove_hook(self, event, plug, cmd=None):
+        self.send(('unhook', event, cmd))
+
+    def msg(self, user, message, length=None, key=None, ttl=None):
+        self.send(('msg', user, message, key, ttl))
+
+    def sendLine(self, line, priority=None, target=None, key=None, ttl=None):
+        self.send(('send', line, priority, target, key, ttl))
+
+    def callLater(self, delay, f, *args, **kw):
+        return reactor.callLater(delay, f, *args, **kw)
+
+    def reconfigure_plug(self, plug, changed):
+        plug.reconfigure(changed)
+
+    def open_store(self, plugname):
+        if self._database is None:
+            self._database = store.Database(self.config['store_file'],
+                self.config['store_flush_interval'], self.log)
+            self._database.open()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self._database.close)
+        return self._database.store(plugname)
+
+    @property
+    def threadpool(self):
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(0, self.config['threads'],
+                                          name='worker')
+            self._threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self._threadpool.stop)
+        return self._threadpool
+
+
+class WorkerUsers(object):
+    """The users a worker has been told about, most recent first.
+
+    Quacks like users.Users as far as looking people up goes.
+
+    """
+    max_users = 10000
+
+    def __init__(self, casemapping):
+        self.users_by_nick = OrderedDict()
+        self.set_casemapping(casemapping)
+
+    def set_casemapping(self, casemapping):
+        self.casemapping = casemapping
+        self._fold_str, self._fold_unicode = users.CASEMAPPINGS.get(
+            casemapping, users.CASEMAPPINGS['rfc1459'])
+        fold = self.fold
+        self.users_by_nick = OrderedDict((fold(user.nickname), user)
+            for user in self.users_by_nick.itervalues())
+
+    def fold(self, name):
+        if isinstance(name, unicode):
+            return name.translate(self._fold_unicode)
+        return name.translate(self._fold_str)
+
+    def by_nick(self, nickname):
+        return self.users_by_nick.get(self.fold(nickname))
+
+    def update(self, record):
+        """Store what the core told us about a user and return the User."""
+        user = users.User.__new__(users.User)
+        for attr, value in record.iteritems():
+            setattr(user, attr, value)
+        user.channels = set(user.channels)
+        key = self.fold(user.nickname)
+        self.users_by_nick.pop(key, None)
+        self.users_by_nick[key] = user
+        if len(self.users_by_nick) > self.max_users:
+            self.users_by_nick.popitem(last=False)
+        return user
+
+    def decode(self, value):
+        """Undo encode(), turning user records back into Users."""
+        if isinstance(value, tuple) and len(value) == 2 and \
+                value[0] == USER_TAG:
+            return self.update(value[1])
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        return value
+
+
+class LogForwarder(logging.Handler):
+    """Sends log records to the core, which logs them as its own."""
+
+    def __init__(self, core):
+        logging.Handler.__init__(self)
+        self.core = core
+
+    def emit(self, record):
+        try:
+            self.core.send(('log', record.levelno, record.name,
+                            self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+
+class WorkerChild(protocol.Protocol):
+    """The worker's end of the pipes, runs the actual plug."""
+
+    def __init__(self):
+        self.framer = Framer()
+        self.core = None
+        self.plug = None
+
+    def send(self, message):
+        self.transport.write(frame(message))
+
+    def dataReceived(self, data):
+        for message in self.framer.feed(data):
+            kind = message[0]
+            if kind == 'event':
+                name, args, known = message[1:]
+                for record in known:
+                    self.core.users.update(record)
+                args = self.core.users.decode(args)
+                if name == 'handle_match':
+                    # The key went over as a list, it has to be a tuple.
+                    pattern, flags, channels = args[4]
+                    args[4] = (pattern, flags,
+                               None if channels is None else tuple(channels))
+                try:
+                    getattr(self.plug, name)(*args)
+                except Exception:
+                    self.core.log.exception('Error in %s', name)
+            elif kind == 'casemapping':
+                self.core.users.set_casemapping(message[1])
+            elif kind == 'start':
+                try:
+                    self.start(*message[1:])
+                except Exception:
+                    self.core.log.exception('Failed to load %s',
+                                            message[1])
+                    self.transport.loseConnection()
+            elif kind == 'stop':
+                if self.plug is not None:
+                    self.plug.cleanup()
+                self.transport.loseConnection()
+
+    def start(self, plugname, config, startingup, casemapping, logname,
+              loglevel):
+        self.core = WorkerCore(self, config, startingup, casemapping, logname)
+        handler = LogForwarder(self.core)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger(logname)
+        logger.addHandler(handler)
+        logger.setLevel(loglevel)
+        logger.propagate = False
+        module = importlib.import_module('plugs.' + plugname)
+        self.plug = module.Plug(self.core, startingup)
+        self.core.plugs[plugname] = self.plug
+        self.plug.hook_events()
+        self.core.confstore.watch(plugname, self.core, self.plug)
+        self.core.confstore.start()
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+def main():
+    # The plug's name is on the command line so it shows up in ps, the rest
+    # comes from the core.
+    stdio.StandardIO(WorkerChild(), stdin=3, stdout=4)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()